@@ -177,6 +177,12 @@ class MiaoShouAssistant(object):
                                               show_label=False, value='Checkpoint', elem_id="my_model_type",
                                               interactive=True, elem_classes="full")
 
+                    with gr.Row():
+                        with gr.Column():
+                            hashing_summary = gr.HTML('<div><span>No models are being hashed</span></div>')
+                            hashing_status = gr.Button(value=f"{self.refresh_symbol} Refresh Hashing Status",
+                                                       elem_id="ms_hash_status")
+
                     with gr.Row():
                         my_models = self.runtime.get_local_models('', my_model_type.value)
                         self.runtime.ds_my_models = gr.Dataset(
@@ -247,6 +253,7 @@ class MiaoShouAssistant(object):
         #open_folder_button.click(self.runtime.open_folder, inputs=[model_folder_path], outputs=[model_folder_path])
         btn_connect_modeldir.click(self.runtime.change_model_folder, inputs=[model_folder_path], outputs=[md_result])
         refresh_models_button.click(self.runtime.refresh_local_models, inputs=[my_search_text, my_model_type], outputs=[self.runtime.ds_my_models])
+        hashing_status.click(self.runtime.get_hashing_status, inputs=[], outputs=[hashing_summary])
         my_model_source_dropdown.change(self.switch_my_model_source,
                                      inputs=[my_model_source_dropdown, my_model_type],
                                      outputs=[self.runtime.ds_my_models])
@@ -296,17 +303,19 @@ class MiaoShouAssistant(object):
                         )
                         btn_search = gr.Button("Search")
 
+                    # the base model and tag choices are labelled with the counts of this first search
+                    images = self.runtime.get_images_html(base_model=self.prelude.base_model_group)
                     with widget.Row(equal_height=True):
-                        rad_model_tags = widget.Radio(choices=['All'] + self.prelude.model_tags,
-                                                show_label=False, value='All', elem_id="rad_model_tags",
-                                                interactive=True, elem_classes="full")
+                        rad_model_tags = widget.Radio(choices=self.runtime.model_tag_choices(),
+                                                show_label=False, value=self.runtime.model_tag_choices()[0],
+                                                elem_id="rad_model_tags", interactive=True, elem_classes="full")
 
                     with widget.Row(equal_height=True):
                         with gr.Accordion(label="Base Model", open=False):
                             rad_all_none = gr.Radio(label='', choices=['All', 'None'], default='All', value='All', interactive=True)
-                            ckg_base_model = gr.CheckboxGroup(label='', choices=self.prelude.base_model_group,
-                                                              default=self.prelude.base_model_group,
-                                                              value=self.prelude.base_model_group,
+                            ckg_base_model = gr.CheckboxGroup(label='', choices=self.runtime.base_model_choices(),
+                                                              default=self.runtime.base_model_choices(),
+                                                              value=self.runtime.base_model_choices(),
                                                               elem_id="ckg_base_model", interactive=True)
                             btn_bm_apply = gr.Button(value="Apply fiter")
 
@@ -321,7 +330,6 @@ class MiaoShouAssistant(object):
                                               show_label=False, value='Default', elem_id="rad_sort",
                                               interactive=True, elem_classes="full")
 
-                    images = self.runtime.get_images_html(base_model=self.prelude.base_model_group)
                     self.runtime.ds_models = widget.Dataset(
                         components=[gr.HTML(visible=False)],
                         headers=None,
@@ -353,6 +361,12 @@ class MiaoShouAssistant(object):
                             download_summary = gr.HTML('<div><span>No downloading tasks ongoing</span></div>')
                             downloading_status = gr.Button(value=f"{self.refresh_symbol} Refresh Downloading Status",
                                                            elem_id="ms_dwn_status")
+                            with gr.Row():
+                                downloading_task = gr.Dropdown(choices=[], label="Downloading Task", show_label=False,
+                                                               value=None, elem_id="dwn_task", interactive=True)
+                                btn_pause_download = gr.Button(value="Pause", elem_id="ms_dwn_pause")
+                                btn_resume_download = gr.Button(value="Resume", elem_id="ms_dwn_resume")
+                                btn_cancel_download = gr.Button(value="Cancel", elem_id="ms_dwn_cancel")
                     with gr.Row():
                         model_version = gr.Dropdown(choices=['Select Version'], label="Version", show_label=False,
                                                      value='Select Version', elem_id='dwn_vname',
@@ -376,15 +390,15 @@ class MiaoShouAssistant(object):
                         model_info = gr.HTML(visible=True)
 
         rad_all_none.change(self.runtime.set_basemodel, inputs=[rad_all_none], outputs=[ckg_base_model])
-        rad_model_tags.change(self.runtime.search_model, inputs=[search_text, nsfw_checker, ckg_base_model, model_type, rad_model_tags], outputs=self.runtime.ds_models)
+        rad_model_tags.change(self.runtime.search_model, inputs=[search_text, nsfw_checker, ckg_base_model, model_type, rad_model_tags], outputs=[self.runtime.ds_models, ckg_base_model, rad_model_tags])
         nsfw_checker.change(self.runtime.set_nsfw, inputs=[search_text, nsfw_checker, ckg_base_model, model_type, rad_model_tags],
-                            outputs=self.runtime.ds_models)
-        btn_bm_apply.click(self.runtime.search_model, inputs=[search_text, nsfw_checker, ckg_base_model, model_type, rad_model_tags], outputs=self.runtime.ds_models)
-        model_type.change(self.runtime.search_model, inputs=[search_text, nsfw_checker, ckg_base_model, model_type, rad_model_tags], outputs=self.runtime.ds_models)
+                            outputs=[self.runtime.ds_models, ckg_base_model, rad_model_tags])
+        btn_bm_apply.click(self.runtime.search_model, inputs=[search_text, nsfw_checker, ckg_base_model, model_type, rad_model_tags], outputs=[self.runtime.ds_models, ckg_base_model, rad_model_tags])
+        model_type.change(self.runtime.search_model, inputs=[search_text, nsfw_checker, ckg_base_model, model_type, rad_model_tags], outputs=[self.runtime.ds_models, ckg_base_model, rad_model_tags])
 
         #btn_fetch.click(self.runtime.refresh_all_models, inputs=[], outputs=self.runtime.ds_models)
-        rad_sort.change(self.runtime.sort_dataset, inputs=[search_text, nsfw_checker, ckg_base_model, model_type, rad_model_tags, rad_sort], outputs=self.runtime.ds_models)
-        btn_search.click(self.runtime.search_model, inputs=[search_text, nsfw_checker, ckg_base_model, model_type, rad_model_tags], outputs=self.runtime.ds_models)
+        rad_sort.change(self.runtime.sort_dataset, inputs=[search_text, nsfw_checker, ckg_base_model, model_type, rad_model_tags, rad_sort], outputs=[self.runtime.ds_models, ckg_base_model, rad_model_tags])
+        btn_search.click(self.runtime.search_model, inputs=[search_text, nsfw_checker, ckg_base_model, model_type, rad_model_tags], outputs=[self.runtime.ds_models, ckg_base_model, rad_model_tags])
 
         self.runtime.ds_models.click(self.runtime.get_model_info,
                                      inputs=[self.runtime.ds_models],
@@ -398,12 +412,17 @@ class MiaoShouAssistant(object):
                                      ])
 
         model_version.change(self.runtime.select_version, inputs=[self.runtime.ds_models, model_version], outputs=[model_dropdown, self.runtime.ds_cover_gallery, open_url_in_browser_newtab_button])
-        dwn_button.click(self.runtime.download_model, inputs=[model_dropdown, model_des_folder], outputs=[download_summary])
-        downloading_status.click(self.runtime.get_downloading_status, inputs=[], outputs=[download_summary])
+        dwn_button.click(self.runtime.download_model, inputs=[model_dropdown, model_des_folder], outputs=[download_summary]) \
+            .then(self.runtime.stream_downloading_status, inputs=[], outputs=[download_summary])
+        downloading_status.click(self.runtime.get_downloading_status, inputs=[], outputs=[download_summary, downloading_task]) \
+            .then(self.runtime.stream_downloading_status, inputs=[], outputs=[download_summary])
+        btn_pause_download.click(self.runtime.pause_download, inputs=[downloading_task], outputs=[download_summary, downloading_task])
+        btn_resume_download.click(self.runtime.resume_download, inputs=[downloading_task], outputs=[download_summary, downloading_task])
+        btn_cancel_download.click(self.runtime.cancel_download, inputs=[downloading_task], outputs=[download_summary, downloading_task])
 
         model_source_dropdown.change(self.switch_model_source,
                                      inputs=[model_source_dropdown, search_text, nsfw_checker, ckg_base_model, model_type, rad_model_tags, rad_sort],
-                                     outputs=[self.runtime.ds_models, dwn_button, open_url_in_browser_newtab_button])
+                                     outputs=[self.runtime.ds_models, dwn_button, open_url_in_browser_newtab_button, ckg_base_model, rad_model_tags])
 
         def tab_downloads_select():
             self.runtime.active_model_set = 'model_set'
@@ -481,37 +500,25 @@ class MiaoShouAssistant(object):
         return gr.Markdown.update(value="Settings Saved", visible=True)
 
     def switch_model_source(self, new_model_source: str, search, chk_nsfw, base_model, model_type, model_tag, sort_by):
-        def sort_key(item, key):
-            if key in item['stats']:
-                return item['stats'][key]
-
         self.runtime.model_source = new_model_source
+        self.runtime.sort_by = sort_by
         show_download_button = self.runtime.model_source != "miaoshouai.com"
 
-        if sort_by != 'Default':
-            self.runtime.sorted_model_set = sorted(self.runtime.model_set, key=lambda item: sort_key(item, sort_by), reverse=True)
-        else:
-            self.runtime.sorted_model_set = self.runtime.model_set
+        images = self.runtime.get_images_html(search, chk_nsfw, base_model, model_type, model_tag)
 
         if self.runtime.ds_models:
-            self.runtime.ds_models.samples = self.runtime.sorted_model_set
-            self.runtime.ds_models.update(samples=self.runtime.sorted_model_set)
+            self.runtime.ds_models.samples = images
         else:
             self.logger.error(f"ds models is null")
 
-        images = self.runtime.get_images_html(search, chk_nsfw, base_model, model_type, model_tag)
-        #images = self.runtime.sort_dataset(search, chk_nsfw, base_model, model_type, model_tag)
-
-        self.runtime.ds_models.samples = images
-        self.runtime.ds_models.update(samples=self.runtime.sorted_model_set)
-
         if self.runtime.model_source not in ['official_models', 'hugging_face', 'controlnet']:
             self.runtime.update_boot_setting('model_source', self.runtime.model_source)
 
         return (
             gr.Dataset.update(samples=images),
             gr.Button.update(visible=show_download_button),
-            gr.HTML.update(visible=not show_download_button)
+            gr.HTML.update(visible=not show_download_button),
+            *self.runtime.get_facet_updates()
         )
 
     def switch_my_model_source(self, new_model_source: str, model_type):
@@ -0,0 +1,262 @@
+import asyncio
+import os
+import typing as t
+
+import scripts.msai_utils.msai_toolkit as toolkit
+from scripts.download.msai_downloader_base import MiaoshouDownloaderBase, RangeNotSatisfiedError, SegmentBook
+from scripts.download.msai_receive_buffer import write_at
+from scripts.download.msai_transfer_control import ConnectionMeter, FatalTransferError, RetryPolicy, \
+    TransferInterrupted
+from scripts.download.resume_checkpoint import BackgroundHasher, CheckpointJournal
+
+try:
+    # gradio depends on aiohttp, but do not make it a hard requirement of the downloader
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+class MiaoshouAsyncFileDownloader(MiaoshouDownloaderBase):
+    """
+    asyncio counterpart of MiaoshouFileDownloader, every transfer is a coroutine on one event loop
+    sharing one aiohttp session, instead of a thread with its own requests session
+    """
+    # bytes buffered per connection, every read hands over all of them in one chunk
+    READ_BUFFER_SIZE = 1024 * 1024
+
+    def __init__(self, session: "aiohttp.ClientSession", *args, **kwargs) -> None:
+        super(MiaoshouAsyncFileDownloader, self).__init__(*args, **kwargs)
+        self.session = session
+
+    @staticmethod
+    def is_available() -> bool:
+        return aiohttp is not None
+
+    @staticmethod
+    def create_session(max_connections: int) -> "aiohttp.ClientSession":
+        """
+        must be called from the event loop the session is used on
+        """
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=30)
+        connector = aiohttp.TCPConnector(limit=max_connections)
+        return aiohttp.ClientSession(connector=connector, timeout=timeout, auto_decompress=False,
+                                     read_bufsize=MiaoshouAsyncFileDownloader.READ_BUFFER_SIZE)
+
+    async def get_file_info_from_server(self, target_url: str) -> t.Tuple[bool, float]:
+        try:
+            headers = {"Accept-Encoding": "identity"}  # Avoid dealing with gzip
+            async with self.session.head(target_url, headers=headers, allow_redirects=True) as response:
+                # only GET responses are judged fatal, urls presigned for GET and some servers refuse HEAD
+                response.raise_for_status()
+                return MiaoshouDownloaderBase.parse_file_info(response.headers)
+        except Exception as ex:
+            self.logger.error(f"HEAD Request Error: {ex}")
+            return False, self.estimated_content_length
+
+    async def download_file_full(self, target_url: str, local_filepath: str) -> t.Optional[str]:
+        loop = asyncio.get_running_loop()
+        # nothing of an earlier attempt is kept
+        self.finished_chunk_size = 0
+        self.update_progress(0)
+        hasher = None
+        try:
+            headers = {"Accept-Encoding": "identity"}  # Avoid dealing with gzip
+            async with self.session.get(target_url, headers=headers) as response:
+                RetryPolicy.check_status(response.status)
+                response.raise_for_status()
+                with self.watch_connection(response) as connection:
+                    # reserve the expected length up front, whatever is not written is cut off at the end,
+                    # posix_fallocate may take a while where it has to write zeros
+                    await loop.run_in_executor(None, toolkit.preallocate_file, local_filepath,
+                                               MiaoshouDownloaderBase.get_known_length(self.content_length))
+                    # hashed on a thread of its own, the loop only writes
+                    hasher = BackgroundHasher(local_filepath)
+                    with open(local_filepath, 'r+b', buffering=0) as file_out:
+                        offset = 0
+                        async for chunk in response.content.iter_any():
+                            write_at(file_out.fileno(), chunk, offset)
+                            offset += len(chunk)
+                            hasher.advance(offset)
+                            self.update_progress(len(chunk))
+                            await connection.async_checkpoint(len(chunk))
+                        await loop.run_in_executor(None, file_out.truncate, offset)
+            return await loop.run_in_executor(None, hasher.finish, offset)
+        except (TransferInterrupted, FatalTransferError):
+            raise
+        except Exception as ex:
+            self.logger.error(f"Download error: {ex}")
+            self.on_transfer_error(ex)
+            return None
+        finally:
+            if hasher is not None:
+                hasher.close()
+
+    async def download_file_ranged(self, target_url: str, local_filepath: str) -> t.Optional[str]:
+        """
+        ranges of the file are fetched concurrently, each connection claims the next range in file order
+        once it is done with one, a small file is a single resumable range
+        """
+        if not self.accept_ranges:
+            return await self.download_file_full(target_url, local_filepath)
+
+        loop = asyncio.get_running_loop()
+        download_checkpoint = local_filepath + ".downloading"
+        content_length = int(self.content_length)
+
+        segments = None
+        if os.path.exists(local_filepath) and os.path.getsize(local_filepath) == content_length:
+            segments = CheckpointJournal.load(download_checkpoint, content_length)
+        if segments is None:
+            segments = MiaoshouDownloaderBase.split_segments(content_length)
+            # posix_fallocate may take a while where it has to write zeros
+            await loop.run_in_executor(None, toolkit.preallocate_file, local_filepath, content_length)
+        else:
+            self.logger.info("File already exists, resuming download.")
+        book = SegmentBook(segments, CheckpointJournal(download_checkpoint, local_filepath, segments),
+                           local_filepath)
+        await loop.run_in_executor(None, book.commit)
+
+        self.finished_chunk_size = 0
+        self.update_progress(book.downloaded_size())
+
+        committing = []
+
+        def on_segment_progress(segment: t.List[int], chunk: bytes, offset: int) -> None:
+            snapshot = book.record(segment, len(chunk))
+            if snapshot is not None:
+                # fsync off the loop, the loop keeps serving other transfers meanwhile
+                future = loop.run_in_executor(None, book.commit, snapshot)
+                committing.append(future)
+                future.add_done_callback(lambda _: committing.remove(future))
+            self.update_progress(len(chunk))
+
+        workers = max(1, min(MiaoshouAsyncFileDownloader.SEGMENT_COUNT, len(book.unfinished())))
+        tasks = [asyncio.ensure_future(self.download_segments(target_url, local_filepath, book,
+                                                              on_segment_progress))
+                 for _ in range(workers)]
+        results = []
+        interrupted = None
+        try:
+            results = await asyncio.gather(*tasks)
+        except RangeNotSatisfiedError as ex:
+            self.logger.warn(f"{ex}, fall back to a single stream")
+            self.accept_ranges = False
+        except (TransferInterrupted, FatalTransferError) as ex:
+            interrupted = ex
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await asyncio.gather(*committing, return_exceptions=True)
+
+        try:
+            if interrupted is not None:
+                # keep what is on disk so far for a resume
+                await loop.run_in_executor(None, book.commit)
+                raise interrupted
+
+            if self.accept_ranges:
+                if not all(results) or os.path.getsize(local_filepath) != content_length:
+                    await loop.run_in_executor(None, book.commit)
+                    return None
+
+                book.journal.remove()
+                # the hasher follows the transfer closely, only what arrived last is left to be read back
+                return await loop.run_in_executor(None, book.hexdigest, content_length)
+        finally:
+            book.close()
+
+        book.journal.remove()
+        await loop.run_in_executor(None, os.remove, local_filepath)
+        return await self.download_file_full(target_url, local_filepath)
+
+    async def download_segments(self, target_url: str, local_filepath: str, book: SegmentBook,
+                                on_progress: t.Callable[[t.List[int], bytes, int], None]) -> bool:
+        """
+        one connection, it fetches claimed segments until none is left or one of them fails
+        """
+        while True:
+            segment = book.claim()
+            if segment is None:
+                return True
+            if not await self.download_segment(target_url, local_filepath, segment, on_progress):
+                # left claimed, the attempt fails once the other connections are done
+                return False
+            book.release(segment)
+
+    async def download_segment(self, target_url: str, local_filepath: str, segment: t.List[int],
+                               on_progress: t.Callable[[t.List[int], bytes, int], None]) -> bool:
+        start, end, _ = segment
+        for i in range(MiaoshouAsyncFileDownloader.SEGMENT_RETRIES):
+            offset = start + segment[2]
+            if offset >= end:
+                return True
+
+            headers = {"Range": f"bytes={offset}-{end - 1}", "Accept-Encoding": "identity"}
+            try:
+                async with self.session.get(target_url, headers=headers) as response:
+                    RetryPolicy.check_status(response.status)
+                    response.raise_for_status()
+                    if response.status != 206:
+                        raise RangeNotSatisfiedError(f"server ignores range requests of {target_url}")
+                    with self.watch_connection(response) as connection:
+                        with open(local_filepath, 'r+b', buffering=0) as file_out:
+                            async for chunk in response.content.iter_any():
+                                if len(chunk) > end - offset:
+                                    chunk = memoryview(chunk)[:end - offset]
+                                # unbuffered, the hasher may read these bytes back through another handle right away
+                                write_at(file_out.fileno(), chunk, offset)
+                                on_progress(segment, chunk, offset)
+                                offset += len(chunk)
+                                await connection.async_checkpoint(len(chunk))
+                                if offset >= end:
+                                    break
+            except (RangeNotSatisfiedError, TransferInterrupted, FatalTransferError):
+                raise
+            except Exception as ex:
+                # stalled or broken, the segment is requested again from where it stopped
+                self.logger.error(f"Segment [{start}, {end}) download error (attempt {i + 1}): {ex}")
+                self.on_transfer_error(ex, reconnect=True)
+                await self.control.async_wait(RetryPolicy.backoff(i))
+
+        return start + segment[2] >= end
+
+    def watch_connection(self, response: "aiohttp.ClientResponse") -> ConnectionMeter:
+        """
+        must be called from the event loop of response, a stalled one is closed there
+        """
+        loop = asyncio.get_running_loop()
+        return self.control.connection(lambda: loop.call_soon_threadsafe(response.close))
+
+    async def transfer(self, local_filepath: str) -> t.Optional[str]:
+        if self.accept_ranges and self.content_length:
+            self.logger.info("Server supports ranges")
+            return await self.download_file_ranged(self.target_url, local_filepath)
+        else:
+            self.logger.info(f"Server doesn't support resume.")
+            return await self.download_file_full(self.target_url, local_filepath)
+
+    async def run_step(self, step: str, *args) -> t.Any:
+        if step == MiaoshouAsyncFileDownloader.STEP_PROBE:
+            return await self.get_file_info_from_server(self.target_url)
+        elif step == MiaoshouAsyncFileDownloader.STEP_WAIT:
+            return await self.control.async_wait(*args)
+        elif step == MiaoshouAsyncFileDownloader.STEP_TRANSFER:
+            return await self.transfer(*args)
+        else:
+            # blocking file system work is kept off the loop
+            return await asyncio.get_running_loop().run_in_executor(None, *args)
+
+    async def download_file(self) -> bool:
+        steps = self.download_steps()
+        result, error = None, None
+        while True:
+            try:
+                step = steps.send(result) if error is None else steps.throw(error)
+            except StopIteration as stop:
+                return stop.value
+            result, error = None, None
+            try:
+                result = await self.run_step(*step)
+            except Exception as ex:
+                error = ex
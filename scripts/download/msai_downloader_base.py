@@ -0,0 +1,307 @@
+import os
+import typing as t
+from threading import Lock
+from urllib.parse import urlparse
+
+import scripts.msai_utils.msai_toolkit as toolkit
+from scripts.download.msai_transfer_control import FatalTransferError, RetryPolicy, TransferAttempt, \
+    TransferControl, TransferInterrupted, TransferProgress
+from scripts.download.resume_checkpoint import BackgroundHasher, CheckpointJournal
+from scripts.msai_logging.msai_logger import Logger
+
+
+class RangeNotSatisfiedError(Exception):
+    pass
+
+
+class SegmentBook(object):
+    """
+    [start, end, downloaded size] of every segment of a ranged transfer, shared by its connections,
+    connections claim unfinished segments in file order, so the contiguous prefix keeps growing,
+    it keeps the journal up to date as chunks arrive and hands the contiguous prefix to a background hasher
+    """
+    def __init__(self, segments: t.List[t.List[int]], journal: CheckpointJournal, data_file: str) -> None:
+        self.segments = sorted(segments)
+        self.journal = journal
+        self._mutex = Lock()
+        self._committing = False
+        # start of every segment held by a connection
+        self._claimed: t.Set[int] = set()
+        # index of the first unfinished segment
+        self._frontier = 0
+        # a resumed prefix is hashed while the rest arrives
+        self.hasher = BackgroundHasher(data_file, self._contiguous_end())
+
+    def _contiguous_end(self) -> int:
+        while self._frontier < len(self.segments):
+            start, end, done = self.segments[self._frontier]
+            if start + done < end:
+                return start + done
+            self._frontier += 1
+        return self.segments[-1][1] if self.segments else 0
+
+    def downloaded_size(self) -> int:
+        with self._mutex:
+            return sum(done for _, _, done in self.segments)
+
+    def unfinished(self) -> t.List[t.List[int]]:
+        with self._mutex:
+            return [segment for segment in self.segments if segment[2] < segment[1] - segment[0]]
+
+    def claim(self) -> t.Optional[t.List[int]]:
+        """
+        :return:
+            the first unfinished segment nobody is working on, None if there is none left
+        """
+        with self._mutex:
+            for segment in self.segments[self._frontier:]:
+                start, end, done = segment
+                if start + done < end and start not in self._claimed:
+                    self._claimed.add(start)
+                    return segment
+        return None
+
+    def release(self, segment: t.List[int]) -> None:
+        with self._mutex:
+            self._claimed.discard(segment[0])
+
+    def record(self, segment: t.List[int], size: int) -> t.Optional[t.List[t.List[int]]]:
+        """
+        :return:
+            a snapshot of the segments if the journal is due to be committed, for the caller to commit it
+            on a thread of its choice, None otherwise
+        """
+        snapshot = None
+        with self._mutex:
+            segment[2] += size
+            end = self._contiguous_end()
+            if self.journal.record(size) and not self._committing:
+                self._committing = True
+                snapshot = [list(s) for s in self.segments]
+
+        self.hasher.advance(end)
+        return snapshot
+
+    def commit(self, snapshot: t.List[t.List[int]] = None) -> None:
+        if snapshot is None:
+            with self._mutex:
+                snapshot = [list(s) for s in self.segments]
+        try:
+            self.journal.commit(snapshot)
+        finally:
+            with self._mutex:
+                self._committing = False
+
+    def hexdigest(self, content_length: int) -> str:
+        """
+        block until the whole file is hashed
+        """
+        return self.hasher.finish(content_length)
+
+    def close(self) -> None:
+        self.hasher.close()
+
+
+class MiaoshouDownloaderBase(object):
+    """
+    what the thread and the asyncio downloaders have in common, above all the state machine of a download:
+    probing the server, attempts with backoff, verifying the checksum and putting the file in place.
+    download_steps() yields every step which needs I/O, the downloader runs it its own way and sends back
+    the result or throws back the error
+    """
+    # initial read size, it adapts to the throughput from there
+    CHUNK_SIZE = 1024 * 1024
+    # connections of a ranged transfer
+    SEGMENT_COUNT = 4
+    # ranges are handed out to the connections in file order in pieces of this size,
+    # small enough for the hashed prefix to follow the transfer closely
+    SEGMENT_SIZE = 16 * 1024 * 1024
+    SEGMENT_RETRIES = 3
+
+    # () -> (accept ranges, content length)
+    STEP_PROBE = "probe"
+    # (seconds) -> None
+    STEP_WAIT = "wait"
+    # (local file path) -> sha256 of the file, None if the attempt failed
+    STEP_TRANSFER = "transfer"
+    # (function, *args) -> result of the function, blocking file system work
+    STEP_CALL = "call"
+
+    def __init__(self, target_url: str = None,
+                 local_file: str = None, local_directory: str = None, estimated_total_length: float = 0.,
+                 expected_checksum: str = None,
+                 progress: TransferProgress = None,
+                 max_retries=5,
+                 control: TransferControl = None,
+                 staging_dir: str = None,
+                 on_verified: t.Callable[[str, str, str], None] = None,
+                 history: t.List[TransferAttempt] = None) -> None:
+        self.logger = Logger()
+        self.control = control or TransferControl()
+        self.history = history if history is not None else []  # shared with the manager
+        self.staging_dir = staging_dir
+        # (target file, staged file, sha256) before the staged file is renamed to the target
+        self.on_verified = on_verified
+        self.checksum: t.Optional[str] = None
+
+        self.target_url: str = target_url
+        self.local_file: str = local_file
+        self.local_directory = local_directory
+        self.expected_checksum = expected_checksum
+        self.max_retries = max_retries
+
+        self.accept_ranges: bool = False
+        self.estimated_content_length = estimated_total_length
+        self.content_length: int = -1
+        self.finished_chunk_size: int = 0
+        self._progress_mutex = Lock()
+
+        self.progress = progress  # shared with the manager
+
+    @staticmethod
+    def get_known_length(content_length: t.Any) -> int:
+        # the estimated length from the catalog may be "unknown"
+        if isinstance(content_length, (int, float)) and content_length > 0:
+            return int(content_length)
+        return 0
+
+    @staticmethod
+    def has_free_space(local_filepath: str, content_length: t.Any) -> bool:
+        required_size = MiaoshouDownloaderBase.get_known_length(content_length)
+        if os.path.exists(local_filepath):
+            # a staged file of an earlier attempt already holds its space
+            required_size -= os.path.getsize(local_filepath)
+
+        free_size = toolkit.get_free_space(local_filepath)
+        if free_size < required_size:
+            Logger().error(f"not enough free space for {local_filepath}: "
+                           f"{toolkit.get_readable_size(required_size)} required, "
+                           f"{toolkit.get_readable_size(free_size)} available")
+            return False
+        return True
+
+    @staticmethod
+    def split_segments(content_length: int) -> t.List[t.List[int]]:
+        segment_size = MiaoshouDownloaderBase.SEGMENT_SIZE
+        return [[start, min(start + segment_size, content_length), 0]
+                for start in range(0, max(content_length, 1), segment_size)]
+
+    @staticmethod
+    def parse_file_info(headers: t.Mapping[str, str]) -> t.Tuple[bool, float]:
+        content_length = None
+        if "Content-Length" in headers:
+            content_length = int(headers['Content-Length'])
+        accept_ranges = (headers.get("Accept-Ranges") == "bytes")
+        return accept_ranges, float(content_length)
+
+    def on_transfer_error(self, ex: Exception, reconnect: bool = False) -> None:
+        if len(self.history) > 0:
+            attempt = self.history[-1]
+            attempt.error = RetryPolicy.describe(ex)
+            if reconnect:
+                attempt.reconnects += 1
+
+    def on_interrupted(self, local_filepath: str, reason: str) -> None:
+        self.logger.info(f"{self.target_url} [  {reason.upper()}  ]")
+        if self.control.is_cancelled():
+            # a paused download keeps its partial file and journal to be resumed
+            for file in [local_filepath, local_filepath + ".downloading"]:
+                if os.path.exists(file):
+                    os.remove(file)
+
+    def update_progress(self, finished_chunk_size: int) -> None:
+        with self._progress_mutex:
+            self.finished_chunk_size += finished_chunk_size
+
+            if self.progress is not None:
+                self.progress.update(self.finished_chunk_size, self.content_length)
+
+    # In order to avoid leaving extra garbage meta files behind this
+    # will overwrite any existing files found at local_file. If you don't want this
+    # behaviour you can handle this externally.
+    # local_file and local_directory could write to unexpected places if the source
+    # is untrusted, be careful!
+    def download_steps(self) -> t.Generator[t.Tuple[t.Any, ...], t.Any, bool]:
+        """
+        :return:
+            True once the verified file is in place
+        """
+        success = False
+        try:
+            print(f"\n\n🚀 miaoshou-assistant downloader: start to download {self.target_url}")
+            self.logger.info(f"miaoshou-assistant downloader: start to download {self.target_url}")
+
+            # Need to rebuild local_file_final each time in case of different urls
+            if not self.local_file:
+                self.local_file = os.path.basename(urlparse(self.target_url).path)
+
+            if self.local_directory:
+                os.makedirs(self.local_directory, exist_ok=True)
+                target_local_file = os.path.join(self.local_directory, self.local_file)
+            else:
+                target_local_file = self.local_file
+
+            # staged on the device of the target, so it is put in place by a rename instead of a copy
+            specific_local_file = toolkit.get_staging_file(target_local_file, self.staging_dir)
+
+            self.accept_ranges, self.content_length = yield (MiaoshouDownloaderBase.STEP_PROBE,)
+            self.logger.info(f"Accept-Ranges: {self.accept_ranges}. content length: {self.content_length}")
+            if not MiaoshouDownloaderBase.has_free_space(specific_local_file, self.content_length):
+                print(f"\n\n😭 miaoshou-assistant downloader: {self.target_url} [not enough free space]")
+                return False
+
+            checksum = None
+            for i in range(self.max_retries):
+                self.logger.info(f"Download Attempt {i + 1}")
+                # an attempt starts with its backoff
+                attempt = TransferAttempt(i + 1, self.finished_chunk_size)
+                self.history.append(attempt)
+                try:
+                    if i > 0:
+                        yield MiaoshouDownloaderBase.STEP_WAIT, RetryPolicy.backoff(i - 1)
+                    checksum = yield MiaoshouDownloaderBase.STEP_TRANSFER, specific_local_file
+                except TransferInterrupted as ex:
+                    attempt.finish(self.finished_chunk_size, str(ex))
+                    yield MiaoshouDownloaderBase.STEP_CALL, self.on_interrupted, specific_local_file, str(ex)
+                    return False
+                except FatalTransferError as ex:
+                    attempt.finish(self.finished_chunk_size, str(ex))
+                    self.logger.error(f"Download error, not retried: {ex}")
+                    break
+
+                if checksum:
+                    if self.expected_checksum and self.expected_checksum.lower() != checksum.lower():
+                        self.logger.info(f"Checksum doesn't match. Calculated {checksum} "
+                                         f"Expecting: {self.expected_checksum}")
+                        attempt.finish(self.finished_chunk_size, "checksum mismatch")
+                    else:
+                        self.logger.info(f"Download successful, Checksum Matched. Checksum {checksum}")
+                        attempt.finish(self.finished_chunk_size)
+                        self.checksum = checksum
+                        success = True
+                        break
+                else:
+                    attempt.finish(self.finished_chunk_size)
+
+            if success:
+                print(f"\n\n🎉 miaoshou-assistant downloader: {self.target_url} [download completed]")
+                self.logger.info(f"{self.target_url} [DOWNLOADED COMPLETELY]")
+                if self.on_verified is not None:
+                    try:
+                        yield (MiaoshouDownloaderBase.STEP_CALL, self.on_verified,
+                               target_local_file, specific_local_file, self.checksum)
+                    except Exception as ex:
+                        self.logger.error(f"on_verified callback of {target_local_file} failed: {ex}")
+                yield MiaoshouDownloaderBase.STEP_CALL, toolkit.replace_file, specific_local_file, target_local_file
+            else:
+                print(f"\n\n😭 miaoshou-assistant downloader: {self.target_url} [download failed]")
+                self.logger.info(f"{self.target_url} [  FAILED  ]")
+                if checksum and os.path.exists(specific_local_file):
+                    # complete but corrupt, nothing to resume from
+                    yield MiaoshouDownloaderBase.STEP_CALL, os.remove, specific_local_file
+
+        except Exception as ex:
+            print(f"\n\n😭 miaoshou-assistant downloader: download failed with unexpected error: {ex}")
+            self.logger.error(f"Unexpected Error: {ex}")  # Only from block above
+
+        return success
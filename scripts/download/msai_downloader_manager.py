@@ -1,33 +1,60 @@
 import asyncio
+import atexit
+import glob
+import heapq
+import html
+import itertools
 import os.path
-import queue
 import requests
 import time
 import typing as t
+from concurrent.futures import Future
 from threading import Thread, Lock
 from urllib.request import Request, urlopen
 
 import scripts.msai_utils.msai_toolkit as toolkit
+from scripts.download.msai_async_downloader import MiaoshouAsyncFileDownloader
 from scripts.download.msai_file_downloader import MiaoshouFileDownloader
+from scripts.download.msai_progress_view import TaskSnapshot
+from scripts.download.msai_transfer_control import BandwidthLimiter, TransferAttempt, TransferControl, \
+    TransferProgress
 from scripts.download.resume_checkpoint import ResumeCheckpoint
 from scripts.msai_logging.msai_logger import Logger
+from scripts.msai_utils.msai_json_file import ResidentJsonFile
 from scripts.msai_utils.msai_singleton import MiaoshouSingleton
 
 
 class DownloadingEntry(object):
+    QUEUED = "queued"
+    RUNNING = "running"
+    PAUSED = "paused"
+    CANCELLED = "cancelled"
+    FINISHED = "finished"
+    # finished without any transfer, an identical file was found locally
+    SATISFIED = "satisfied locally"
+    FAILED = "failed"
+
     def __init__(self, target_url: str = None, local_file: str = None,
-                 local_directory: str = None, estimated_total_size: float = 0., expected_checksum: str = None):
+                 local_directory: str = None, estimated_total_size: float = 0., expected_checksum: str = None,
+                 priority: float = None, max_bytes_per_second: float = 0.):
         self._target_url = target_url
         self._local_file = local_file
         self._local_directory = local_directory
         self._expected_checksum = expected_checksum
 
         self._estimated_total_size = estimated_total_size
-        self._total_size = 0
-        self._downloaded_size = 0
+        self.progress = TransferProgress()
+        # appended by the downloaders, across pauses and resumes
+        self.attempts: t.List[TransferAttempt] = []
+
+        # lower goes first, by default smaller files go first, covers and files of unknown size included
+        self._priority = priority if priority is not None \
+            else float(MiaoshouFileDownloader.get_known_length(estimated_total_size))
+        self._max_bytes_per_second = max_bytes_per_second
+        self.control: t.Optional[TransferControl] = None
 
-        self._downloading = False
-        self._failure = False
+        self._state = DownloadingEntry.QUEUED
+        self._finished_time: t.Optional[float] = None
 
     @property
     def target_url(self) -> str:
@@ -47,36 +74,90 @@ class DownloadingEntry(object):
 
     @property
     def total_size(self) -> int:
-        return self._total_size
-
-    @total_size.setter
-    def total_size(self, sz: int) -> None:
-        self._total_size = sz
+        return self.progress.total_size
 
     @property
     def downloaded_size(self) -> int:
-        return self._downloaded_size
-
-    @downloaded_size.setter
-    def downloaded_size(self, sz: int) -> None:
-        self._downloaded_size = sz
+        return self.progress.downloaded_size
 
     @property
     def estimated_size(self) -> float:
         return self._estimated_total_size
 
+    @property
+    def priority(self) -> float:
+        return self._priority
+
+    @property
+    def max_bytes_per_second(self) -> float:
+        return self._max_bytes_per_second
+
+    @property
+    def state(self) -> str:
+        return self._state
+
+    @state.setter
+    def state(self, state: str) -> None:
+        self._state = state
+        self._finished_time = None if self.is_active() else time.monotonic()
+
+    @property
+    def finished_time(self) -> t.Optional[float]:
+        return self._finished_time
+
+    def is_active(self) -> bool:
+        return self._state in [DownloadingEntry.QUEUED, DownloadingEntry.RUNNING, DownloadingEntry.PAUSED]
+
+    def is_queued(self) -> bool:
+        return self._state == DownloadingEntry.QUEUED
+
+    def is_paused(self) -> bool:
+        return self._state == DownloadingEntry.PAUSED
+
+    def is_cancelled(self) -> bool:
+        return self._state == DownloadingEntry.CANCELLED
+
     def is_downloading(self) -> bool:
-        return self._downloading
+        return self._state == DownloadingEntry.RUNNING
 
     def start_download(self) -> None:
-        self._downloading = True
-
-    def update_final_status(self, result: bool) -> None:
-        self._failure = (result is False)
-        self._downloading = False
+        self._state = DownloadingEntry.RUNNING
+
+    def update_final_status(self, result: bool, satisfied_locally: bool = False) -> None:
+        if result:
+            self.state = DownloadingEntry.SATISFIED if satisfied_locally else DownloadingEntry.FINISHED
+        elif self.control is not None and self.control.is_cancelled():
+            self.state = DownloadingEntry.CANCELLED
+        elif self.control is not None and self.control.is_paused():
+            self.state = DownloadingEntry.PAUSED
+        else:
+            self.state = DownloadingEntry.FAILED
 
     def is_failure(self) -> bool:
-        return self._failure
+        return self._state == DownloadingEntry.FAILED
+
+    def to_dict(self) -> t.Dict[str, t.Any]:
+        return {
+            "target_file": os.path.join(self._local_directory, self._local_file),
+            "estimated_size": self._estimated_total_size,
+            "checksum": self._expected_checksum,
+            "priority": self._priority,
+            "max_bytes_per_second": self._max_bytes_per_second,
+            # a running task is queued again after a restart
+            "state": DownloadingEntry.PAUSED if self.is_paused() else DownloadingEntry.QUEUED,
+        }
+
+    @staticmethod
+    def from_dict(target_url: str, task: t.Dict[str, t.Any]) -> "DownloadingEntry":
+        return DownloadingEntry(
+            target_url=target_url,
+            local_file=os.path.basename(task["target_file"]),
+            local_directory=os.path.dirname(task["target_file"]),
+            estimated_total_size=task.get("estimated_size"),
+            expected_checksum=task.get("checksum"),
+            priority=task.get("priority"),
+            max_bytes_per_second=task.get("max_bytes_per_second", 0.),
+        )
 
 
 class AsyncLoopThread(Thread):
@@ -94,102 +175,324 @@ class AsyncLoopThread(Thread):
 
 class MiaoshouDownloaderManager(metaclass=MiaoshouSingleton):
     _downloading_entries: t.Dict[str, DownloadingEntry] = None
-
-    def __init__(self):
+    MAX_CONCURRENT_TRANSFERS = 4
+    MAX_CONNECTIONS = 16
+    # progress is published to readers at most this often
+    PUBLISH_INTERVAL = 0.5
+    # finished, failed and cancelled entries are dropped after this many seconds
+    RETENTION_SECONDS = 300.
+    QUEUE_VERSION = 1
+
+    def __init__(self, use_asyncio: bool = True, max_concurrent_transfers: int = MAX_CONCURRENT_TRANSFERS,
+                 max_bytes_per_second: float = 0., local_file_resolver: t.Callable[[str], t.Optional[str]] = None,
+                 staging_dir: str = None, queue_file: str = None,
+                 on_verified: t.Callable[[str, str, str], None] = None):
         if self._downloading_entries is None:
             self._downloading_entries = {}
-            self.message_queue = queue.Queue()
+            # downloads are staged here if it is on the device of their destination, next to it otherwise
+            self.staging_dir = staging_dir or None
+            # (target file, file holding its bytes, sha256) once the content of a target is known
+            self.on_verified = on_verified
+            # sha256 -> path of an identical local file, it may block on disk
+            self.local_file_resolver = local_file_resolver
+
+            # transfers run as coroutines on the looper, threads are only the fallback without aiohttp
+            self.use_asyncio = use_asyncio and MiaoshouAsyncFileDownloader.is_available()
+            # bound to the looper's loop, so it is created on it
+            self._async_session = None
+
+            # scheduler state, only touched on the looper's loop
+            self._pending: t.List[t.Tuple[float, int, str]] = []  # heap of (priority, sequence, url)
+            self._sequence = itertools.count()
+            self._running_transfers: t.Dict[str, asyncio.Task] = {}
+            self._max_concurrent_transfers = max(1, max_concurrent_transfers)
+            self.bandwidth_limiter = BandwidthLimiter(max_bytes_per_second)
 
             self.logger = Logger()
             self.looper = AsyncLoopThread()
             self.looper.start()
-            self.logger.info("download manager is ready")
+            self.logger.info(f"download manager is ready, {'asyncio' if self.use_asyncio else 'thread'} transfers")
             self._mutex = Lock()
 
+            # unfinished tasks survive a restart, they are queued again from here
+            self._queue_file: t.Optional[ResidentJsonFile] = None
+            if queue_file:
+                self._queue_file = ResidentJsonFile(
+                    queue_file, default=lambda: {"version": MiaoshouDownloaderManager.QUEUE_VERSION, "tasks": {}})
+                atexit.register(self._queue_file.flush)
+                self._restore_queue()
+
         ResumeCheckpoint.cleanup_checkpoints_if_needed(toolkit.get_user_temp_dir())
         ResumeCheckpoint.store_version_info(toolkit.get_user_temp_dir())
 
-    def consume_all_ready_messages(self) -> None:
+    def _load_queue(self) -> t.Dict[str, t.Dict[str, t.Any]]:
+        if self._queue_file is None:
+            return {}
+        with self._queue_file.mutex:
+            content = self._queue_file.load()
+            if not isinstance(content, dict) or content.get("version") != MiaoshouDownloaderManager.QUEUE_VERSION:
+                return {}
+            return dict(content.get("tasks") or {})
+
+    def _save_queue(self) -> None:
+        if self._queue_file is None:
+            return
+
+        try:
+            self._mutex.acquire(blocking=True)
+            tasks = {url: entry.to_dict() for url, entry in self._downloading_entries.items() if entry.is_active()}
+        finally:
+            self._mutex.release()
+
+        with self._queue_file.mutex:
+            content = self._queue_file.load()
+            if not isinstance(content, dict):
+                content = {}
+            content.clear()
+            content.update({"version": MiaoshouDownloaderManager.QUEUE_VERSION, "tasks": tasks})
+            self._queue_file.mark_dirty()
+
+    def _restore_queue(self) -> None:
+        tasks = self._load_queue()
+        for url, task in tasks.items():
+            try:
+                download_entry = DownloadingEntry.from_dict(url, task)
+            except (KeyError, TypeError) as ex:
+                self.logger.warn(f"skip broken downloading task {url}: {ex}")
+                continue
+
+            paused = task.get("state") == DownloadingEntry.PAUSED
+            asyncio.run_coroutine_threadsafe(self._submit_task(download_entry, paused), self.looper.loop)
+        if len(tasks) > 0:
+            self.logger.info(f"{len(tasks)} downloading tasks restored")
+
+    def collect_orphaned_partials(self, folders: t.List[str], max_bytes: float) -> None:
         """
-        capture all enqueued messages, this method should not be used if you are iterating over the message queue
-        :return:
-            None
-        :side-effect:
-            update downloading entries' status
+        partial files of no queued task are kept for a later download of the same file while they fit
+        in max_bytes, beyond it the least recently written ones are deleted
         """
-        while True:
-            # self.logger.info("fetching the enqueued message")
+        known_files = set()
+        for task in self._load_queue().values():
+            staging_file = toolkit.get_staging_file(task.get("target_file", ""), self.staging_dir)
+            known_files.update([staging_file, staging_file + ".downloading"])
+
+        staging_files = []
+        unfinished_writes = set()
+        for folder in set([f for f in folders + [self.staging_dir] if f]):
+            # downloads are staged next to their target, which is often a subfolder of a model folder
+            pattern = os.path.join(glob.escape(folder), "**", "*" + toolkit.STAGING_SUFFIX)
+            staging_files += glob.glob(pattern, recursive=True)
+            # journal writes cut short by a crash
+            unfinished_writes.update(glob.glob(pattern + ".downloading.*.tmp", recursive=True))
+        for file in unfinished_writes:
             try:
-                (aurl, finished_size, total_size) = self.message_queue.get(block=False, timeout=0.2)
-                # self.logger.info(f"[+] message ([{finished_size}/{total_size}]   {aurl}")
+                os.remove(file)
+            except OSError:
+                pass
+        # staged by earlier versions of the downloader
+        legacy_dir = toolkit.get_user_temp_dir()
+        staging_files += [f for f in glob.glob(os.path.join(glob.escape(legacy_dir), "*"))
+                          if not f.endswith(".downloading")]
+
+        orphans = []
+        for file in set(staging_files):
+            if file in known_files or not os.path.isfile(file):
+                continue
+            stat = os.stat(file)
+            orphans.append((stat.st_mtime, stat.st_size, file))
+
+        orphans.sort(reverse=True)
+        kept_bytes = 0
+        for mtime, size, file in orphans:
+            kept_bytes += size
+            if kept_bytes <= max_bytes:
+                continue
+            self.logger.info(f"delete orphaned partial file {file} ({toolkit.get_readable_size(size)})")
+            for f in [file, file + ".downloading"]:
                 try:
-                    self._mutex.acquire(blocking=True)
-                    self._downloading_entries[aurl].total_size = total_size
-                    self._downloading_entries[aurl].downloaded_size = finished_size
-                finally:
-                    self._mutex.release()
-            except queue.Empty:
-                break
+                    os.remove(f)
+                except OSError:
+                    pass
+
+    def _evict_finished_entries(self) -> None:
+        # the caller holds self._mutex
+        expire_time = time.monotonic() - MiaoshouDownloaderManager.RETENTION_SECONDS
+        for url in [url for url, entry in self._downloading_entries.items()
+                    if entry.finished_time is not None and entry.finished_time < expire_time]:
+            del self._downloading_entries[url]
+
+    def snapshot(self) -> t.Dict[str, TaskSnapshot]:
+        """
+        read progress counters of all tasks without waiting for any transfer
+        :return:
+            {target url: TaskSnapshot}
+        """
+        try:
+            self._mutex.acquire(blocking=True)
+            self._evict_finished_entries()
+            entries = list(self._downloading_entries.items())
+        finally:
+            self._mutex.release()
+
+        return {url: TaskSnapshot(entry.local_file, entry.state, entry.downloaded_size, entry.total_size,
+                                  entry.estimated_size, len(entry.attempts),
+                                  entry.attempts[-1].error if len(entry.attempts) > 0 else None)
+                for url, entry in entries}
 
-    def iterator(self) -> t.Tuple[float, float]:
+    def attempt_history(self, target_url: str) -> t.List[TransferAttempt]:
+        try:
+            self._mutex.acquire(blocking=True)
+            download_entry = self._downloading_entries.get(target_url)
+            return list(download_entry.attempts) if download_entry is not None else []
+        finally:
+            self._mutex.release()
 
+    def snapshots(self) -> t.Iterator[t.Dict[str, TaskSnapshot]]:
+        """
+        yield a snapshot every PUBLISH_INTERVAL seconds, the last one is taken after no task is active any more
+        """
+        active_states = [DownloadingEntry.QUEUED, DownloadingEntry.RUNNING]
         while True:
-            self.logger.info("waiting for incoming message")
+            snapshot = self.snapshot()
+            yield snapshot
 
-            try:
-                (aurl, finished_size, total_size) = self.message_queue.get(block=True)
-                self.logger.info(f"[+] message ([{finished_size}/{total_size}]   {aurl}")
-                try:
-                    self._mutex.acquire(blocking=True)
-                    self._downloading_entries[aurl].total_size = total_size
-                    self._downloading_entries[aurl].downloaded_size = finished_size
-
-                    tasks_total_size = 0.
-                    tasks_finished_size = 0.
-
-                    for e in self._downloading_entries.values():
-                        tasks_total_size += e.total_size
-                        tasks_finished_size += e.downloaded_size
-
-                    yield tasks_finished_size, tasks_total_size
-                finally:
-                    self._mutex.release()
-            except queue.Empty:
-                if len(asyncio.all_tasks(self.looper.loop)) == 0:
-                    self.logger.info("all downloading tasks finished")
-                    break
-
-    async def _submit_task(self, download_entry: DownloadingEntry) -> None:
+            if all(task.state not in active_states for task in snapshot.values()):
+                self.logger.info("all downloading tasks finished")
+                break
+            time.sleep(MiaoshouDownloaderManager.PUBLISH_INTERVAL)
+
+    def iterator(self) -> t.Iterator[t.Tuple[float, float]]:
+        """
+        yield (finished size, total size) of all tasks until none is active
+        """
+        for snapshot in self.snapshots():
+            tasks_total_size = sum(task.total_size for task in snapshot.values())
+            tasks_finished_size = sum(task.downloaded_size for task in snapshot.values())
+            yield tasks_finished_size, tasks_total_size
+
+    async def _submit_task(self, download_entry: DownloadingEntry, paused: bool = False) -> None:
         try:
             self._mutex.acquire(blocking=True)
-            if download_entry.target_url in self._downloading_entries:
+            existing_entry = self._downloading_entries.get(download_entry.target_url)
+            if existing_entry is not None and existing_entry.is_active():
                 self.logger.warn(f"{download_entry.target_url} is already downloading")
                 return
             else:
-                download_entry.start_download()
+                limiters = [self.bandwidth_limiter]
+                if download_entry.max_bytes_per_second:
+                    limiters.append(BandwidthLimiter(download_entry.max_bytes_per_second))
+                download_entry.control = TransferControl(limiters)
                 self._downloading_entries[download_entry.target_url] = download_entry
         finally:
             self._mutex.release()
 
-        file_downloader = MiaoshouFileDownloader(
-            target_url=download_entry.target_url,
-            local_file=download_entry.local_file,
-            local_directory=download_entry.local_directory,
-            channel=self.message_queue if download_entry.estimated_size else None,
-            estimated_total_length=download_entry.estimated_size,
-            expected_checksum=download_entry.expected_checksum,
-        )
+        if paused:
+            download_entry.state = DownloadingEntry.PAUSED
+        else:
+            self._enqueue(download_entry)
+        self._save_queue()
+
+    def _enqueue(self, download_entry: DownloadingEntry) -> None:
+        download_entry.state = DownloadingEntry.QUEUED
+        heapq.heappush(self._pending, (download_entry.priority, next(self._sequence), download_entry.target_url))
+        self._schedule()
+
+    def _schedule(self) -> None:
+        while len(self._running_transfers) < self._max_concurrent_transfers and len(self._pending) > 0:
+            _, _, url = heapq.heappop(self._pending)
+            download_entry = self._downloading_entries.get(url)
+            if download_entry is None or not download_entry.is_queued():
+                # paused or cancelled while waiting
+                continue
+
+            download_entry.start_download()
+            self._running_transfers[url] = self.looper.loop.create_task(self._run_transfer(download_entry))
+
+    async def _satisfy_locally(self, download_entry: DownloadingEntry) -> bool:
+        """
+        materialize the target from an identical local file instead of downloading it
+        :return:
+            True if the target is in place without any network I/O
+        """
+        if not download_entry.expected_checksum or self.local_file_resolver is None:
+            return False
 
-        result: bool = await self.looper.loop.run_in_executor(None, file_downloader.download_file)
+        loop = self.looper.loop
+        target_file = os.path.join(download_entry.local_directory, download_entry.local_file)
+        try:
+            source_file = await loop.run_in_executor(None, self.local_file_resolver,
+                                                     download_entry.expected_checksum)
+            if source_file is None:
+                return False
 
+            if os.path.normcase(os.path.abspath(source_file)) == os.path.normcase(os.path.abspath(target_file)):
+                method = "existing file"
+            else:
+                method = await loop.run_in_executor(None, toolkit.clone_file, source_file, target_file)
+            size = os.path.getsize(target_file)
+            if self.on_verified is not None:
+                await loop.run_in_executor(None, self.on_verified, target_file, target_file,
+                                           download_entry.expected_checksum)
+        except Exception as ex:
+            self.logger.error(f"failed to reuse a local copy of {download_entry.local_file}: {ex}")
+            return False
+
+        download_entry.progress.update(size, size)
+        self.logger.info(f"{target_file} [SATISFIED LOCALLY] by {method} of {source_file}")
+        return True
+
+    async def _run_transfer(self, download_entry: DownloadingEntry) -> None:
+        result = False
+        satisfied_locally = False
         try:
-            self._mutex.acquire(blocking=True)
-            self._downloading_entries[download_entry.target_url].update_final_status(result)
+            if await self._satisfy_locally(download_entry):
+                result = satisfied_locally = True
+            elif self.use_asyncio:
+                if self._async_session is None:
+                    self._async_session = MiaoshouAsyncFileDownloader.create_session(
+                        MiaoshouDownloaderManager.MAX_CONNECTIONS)
+                file_downloader = MiaoshouAsyncFileDownloader(
+                    self._async_session,
+                    target_url=download_entry.target_url,
+                    local_file=download_entry.local_file,
+                    local_directory=download_entry.local_directory,
+                    progress=download_entry.progress,
+                    estimated_total_length=download_entry.estimated_size,
+                    expected_checksum=download_entry.expected_checksum,
+                    control=download_entry.control,
+                    staging_dir=self.staging_dir,
+                    on_verified=self.on_verified,
+                    history=download_entry.attempts,
+                )
+                result = await file_downloader.download_file()
+            else:
+                file_downloader = MiaoshouFileDownloader(
+                    target_url=download_entry.target_url,
+                    local_file=download_entry.local_file,
+                    local_directory=download_entry.local_directory,
+                    progress=download_entry.progress,
+                    estimated_total_length=download_entry.estimated_size,
+                    expected_checksum=download_entry.expected_checksum,
+                    control=download_entry.control,
+                    staging_dir=self.staging_dir,
+                    on_verified=self.on_verified,
+                    history=download_entry.attempts,
+                )
+                result = await self.looper.loop.run_in_executor(None, file_downloader.download_file)
+        except Exception as ex:
+            self.logger.error(f"transfer of {download_entry.target_url} failed: {ex}")
         finally:
-            self._mutex.release()
+            try:
+                self._mutex.acquire(blocking=True)
+                download_entry.update_final_status(result, satisfied_locally)
+            finally:
+                self._mutex.release()
+            self._running_transfers.pop(download_entry.target_url, None)
+            self._save_queue()
+            self._schedule()
 
     def download(self, source_url: str, target_file: str, estimated_total_size: float,
-                 expected_checksum: str = None) -> None:
+                 expected_checksum: str = None, priority: float = None, max_bytes_per_second: float = 0.) -> None:
         self.logger.info(f"start to download '{source_url}'")
 
         target_dir = os.path.dirname(target_file)
@@ -199,39 +502,147 @@ class MiaoshouDownloaderManager(metaclass=MiaoshouSingleton):
             local_file=target_filename,
             local_directory=target_dir,
             estimated_total_size=estimated_total_size,
-            expected_checksum=expected_checksum
+            expected_checksum=expected_checksum,
+            priority=priority,
+            max_bytes_per_second=max_bytes_per_second,
         )
 
         asyncio.run_coroutine_threadsafe(self._submit_task(download_entry), self.looper.loop)
 
-    def tasks_summary(self) -> t.Tuple[int, int, str]:
-        self.consume_all_ready_messages()
+    def pause(self, target_url: str) -> Future:
+        """
+        :return:
+            a future done once the looper has applied it
+        """
+        return asyncio.run_coroutine_threadsafe(self._pause(target_url), self.looper.loop)
+
+    async def _pause(self, target_url: str) -> None:
+        download_entry = self._downloading_entries.get(target_url)
+        if download_entry is None:
+            return
+        if download_entry.is_queued():
+            download_entry.state = DownloadingEntry.PAUSED
+            self._save_queue()
+        elif download_entry.is_downloading():
+            # the transfer stops at its next chunk, keeping its partial file and journal
+            download_entry.control.pause()
+
+    def resume(self, target_url: str) -> Future:
+        """
+        :return:
+            a future done once the looper has applied it
+        """
+        return asyncio.run_coroutine_threadsafe(self._resume(target_url), self.looper.loop)
+
+    async def _resume(self, target_url: str) -> None:
+        download_entry = self._downloading_entries.get(target_url)
+        if download_entry is None:
+            return
+        download_entry.control.resume()
+        if download_entry.is_paused():
+            self._enqueue(download_entry)
+            self._save_queue()
+
+    def cancel(self, target_url: str) -> Future:
+        """
+        :return:
+            a future done once the looper has applied it
+        """
+        return asyncio.run_coroutine_threadsafe(self._cancel(target_url), self.looper.loop)
+
+    async def _cancel(self, target_url: str) -> None:
+        download_entry = self._downloading_entries.get(target_url)
+        if download_entry is None:
+            return
+        download_entry.control.cancel()
+        if download_entry.is_queued() or download_entry.is_paused():
+            download_entry.state = DownloadingEntry.CANCELLED
+            # a paused transfer leaves its partial file behind
+            partial_file = toolkit.get_staging_file(
+                os.path.join(download_entry.local_directory, download_entry.local_file), self.staging_dir)
+            for file in [partial_file, partial_file + ".downloading"]:
+                if os.path.exists(file):
+                    os.remove(file)
+            self._save_queue()
+
+    def set_max_concurrent_transfers(self, max_concurrent_transfers: int) -> None:
+        def _apply():
+            self._max_concurrent_transfers = max(1, max_concurrent_transfers)
+            self._schedule()
+
+        self.looper.loop.call_soon_threadsafe(_apply)
+
+    def set_bandwidth_limit(self, max_bytes_per_second: float) -> None:
+        self.bandwidth_limiter.rate = max_bytes_per_second
+
+    def find_target_url(self, local_file: str) -> t.Optional[str]:
+        try:
+            self._mutex.acquire(blocking=True)
+            for url, entry in self._downloading_entries.items():
+                if entry.local_file == local_file:
+                    return url
+            return None
+        finally:
+            self._mutex.release()
 
+    def active_tasks(self) -> t.List[str]:
+        """
+        :return:
+            local file names of queued, running and paused tasks
+        """
+        try:
+            self._mutex.acquire(blocking=True)
+            return [entry.local_file for entry in self._downloading_entries.values() if entry.is_active()]
+        finally:
+            self._mutex.release()
+
+    def tasks_summary(self) -> t.Tuple[int, int, str]:
         total_tasks_num = 0
         ongoing_tasks_num = 0
+        queued_tasks_num = 0
         failed_tasks_num = 0
+        stopped_tasks_num = 0
 
         try:
             description = "<div>"
             self._mutex.acquire(blocking=True)
+            self._evict_finished_entries()
             for name, entry in self._downloading_entries.items():
                 if entry.estimated_size is None:
                     continue
 
                 total_tasks_num += 1
 
-                if entry.total_size > 0.:
-                    description += f"<p>{entry.local_file} ({toolkit.get_readable_size(entry.total_size)}) : "
-                else:
-                    description += f"<p>{entry.local_file} ({toolkit.get_readable_size(entry.estimated_size)}) : "
+                # the catalog says "unknown" for files without a size
+                total_size = MiaoshouFileDownloader.get_known_length(entry.total_size) \
+                    or MiaoshouFileDownloader.get_known_length(entry.estimated_size)
+                readable_size = toolkit.get_readable_size(total_size) if total_size > 0 else "unknown size"
+                description += f"<p>{entry.local_file} ({readable_size}) : "
 
                 if entry.is_downloading():
                     ongoing_tasks_num += 1
-                    finished_percent = entry.downloaded_size/entry.estimated_size * 100
-                    description += f'<span style="color:blue;font-weight:bold">{round(finished_percent, 2)} %</span>'
+                    if total_size > 0:
+                        finished_percent = min(100., entry.downloaded_size / total_size * 100)
+                        description += f'<span style="color:blue;font-weight:bold">{round(finished_percent, 2)} %</span>'
+                    else:
+                        description += f'<span style="color:blue;font-weight:bold">' \
+                                       f'{toolkit.get_readable_size(entry.downloaded_size)}</span>'
+                elif entry.is_queued():
+                    queued_tasks_num += 1
+                    description += '<span style="color:gray;font-weight:bold">queued</span>'
+                elif entry.is_paused():
+                    stopped_tasks_num += 1
+                    description += '<span style="color:orange;font-weight:bold">paused</span>'
+                elif entry.is_cancelled():
+                    stopped_tasks_num += 1
+                    description += '<span style="color:gray;font-weight:bold">cancelled</span>'
                 elif entry.is_failure():
                     failed_tasks_num += 1
                     description += '<span style="color:red;font-weight:bold">failed!</span>'
+                    if len(entry.attempts) > 0 and entry.attempts[-1].error:
+                        description += f" after {len(entry.attempts)} attempts, {html.escape(entry.attempts[-1].error)}"
+                elif entry.state == DownloadingEntry.SATISFIED:
+                    description += '<span style="color:green;font-weight:bold">satisfied locally</span>'
                 else:
                     description += '<span style="color:green;font-weight:bold">finished</span>'
                 description += "</p><br>"
@@ -242,8 +653,9 @@ class MiaoshouDownloaderManager(metaclass=MiaoshouSingleton):
         description += "</div>"
         overall = f"""
                     <h4>
-                        <span style="color:blue;font-weight:bold">{ongoing_tasks_num}</span> ongoing, 
-                        <span style="color:green;font-weight:bold">{total_tasks_num - ongoing_tasks_num - failed_tasks_num}</span> finished, 
+                        <span style="color:blue;font-weight:bold">{ongoing_tasks_num}</span> running, 
+                        <span style="color:gray;font-weight:bold">{queued_tasks_num}</span> queued, 
+                        <span style="color:green;font-weight:bold">{total_tasks_num - ongoing_tasks_num - queued_tasks_num - failed_tasks_num - stopped_tasks_num}</span> finished, 
                         <span style="color:red;font-weight:bold">{failed_tasks_num}</span> failed.
                     </h4>
                     <br>
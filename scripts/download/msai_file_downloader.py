@@ -1,221 +1,322 @@
 import os
-import pickle
-import queue
-import requests
-import time
+import socket
 import typing as t
-from pathlib import Path
-from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
-from urllib.parse import urlparse
-from urllib3.util import Retry
 
 import scripts.msai_utils.msai_toolkit as toolkit
-from scripts.download.resume_checkpoint import ResumeCheckpoint
-from scripts.msai_logging.msai_logger import Logger
-
-
-class MiaoshouFileDownloader(object):
-    CHUNK_SIZE = 1024 * 1024
-
-    def __init__(self, target_url: str = None,
-                 local_file: str = None, local_directory: str = None, estimated_total_length: float = 0.,
-                 expected_checksum: str = None,
-                 channel: queue.Queue = None,
-                 max_retries=5) -> None:
-        self.logger = Logger()
-
-        self.target_url: str = target_url
-        self.local_file: str = local_file
-        self.local_directory = local_directory
-        self.expected_checksum = expected_checksum
-        self.max_retries = max_retries
-
-        self.accept_ranges: bool = False
-        self.estimated_content_length = estimated_total_length
-        self.content_length: int = -1
-        self.finished_chunk_size: int = 0
-
-        self.channel = channel  # for communication
-
-        # Support 3 retries and backoff
-        retry_strategy = Retry(
-            total=3,
-            backoff_factor=1,
-            status_forcelist=[429, 500, 502, 503, 504],
-            allowed_methods=["HEAD", "GET", "OPTIONS"]
-        )
-        adapter = HTTPAdapter(max_retries=retry_strategy)
-        self.session = requests.Session()
-        self.session.mount("https://", adapter)
-        self.session.mount("http://", adapter)
-
-        # inform message receiver at once
-        if self.channel:
-            self.channel.put_nowait((
-                self.target_url,
-                self.finished_chunk_size,
-                self.estimated_content_length,
-            ))
+from scripts.download.msai_downloader_base import MiaoshouDownloaderBase, RangeNotSatisfiedError, SegmentBook
+from scripts.download.msai_receive_buffer import ReceiveBuffer, body_stream, write_at
+from scripts.download.msai_transfer_control import ConnectionMeter, FatalTransferError, RetryPolicy, \
+    TransferInterrupted
+from scripts.download.resume_checkpoint import CheckpointJournal, StreamingHasher
+from scripts.msai_utils.msai_http import MiaoshouHttpClient
+
+
+class MiaoshouFileDownloader(MiaoshouDownloaderBase):
+    """
+    runs a download on the calling thread, a segmented one on a thread per connection
+    """
+    def __init__(self, *args, **kwargs) -> None:
+        super(MiaoshouFileDownloader, self).__init__(*args, **kwargs)
+        # pooled connections, timeouts and retries are shared with every other request of the process
+        self.session = MiaoshouHttpClient()
 
     # Head request to get file-length and check whether it supports ranges.
     def get_file_info_from_server(self, target_url: str) -> t.Tuple[bool, float]:
         try:
             headers = {"Accept-Encoding": "identity"}  # Avoid dealing with gzip
-            response = requests.head(target_url, headers=headers, allow_redirects=True, timeout=10)
+            response = self.session.head(target_url, headers=headers)
+            # only GET responses are judged fatal, urls presigned for GET and some servers refuse HEAD
             response.raise_for_status()
-            content_length = None
-            if "Content-Length" in response.headers:
-                content_length = int(response.headers['Content-Length'])
-            accept_ranges = (response.headers.get("Accept-Ranges") == "bytes")
-            return accept_ranges, float(content_length)
+            return MiaoshouDownloaderBase.parse_file_info(response.headers)
         except Exception as ex:
             self.logger.error(f"HEAD Request Error: {ex}")
             return False, self.estimated_content_length
 
     def download_file_full(self, target_url: str, local_filepath: str) -> t.Optional[str]:
+        hasher = StreamingHasher(local_filepath)
+        # nothing of an earlier attempt is kept
+        self.finished_chunk_size = 0
+        self.update_progress(0)
         try:
             headers = {"Accept-Encoding": "identity"}  # Avoid dealing with gzip
 
+            # reserve the expected length up front, whatever is not written is cut off at the end
+            toolkit.preallocate_file(local_filepath, MiaoshouFileDownloader.get_known_length(self.content_length))
             with tqdm(total=self.content_length, unit="byte", unit_scale=1, colour="GREEN",
                       desc=os.path.basename(self.local_file)) as progressbar, \
-                    self.session.get(target_url, headers=headers, stream=True, timeout=5) as response, \
-                    open(local_filepath, 'wb') as file_out:
+                    self.session.get(target_url, headers=headers, stream=True) as response, \
+                    open(local_filepath, 'r+b', buffering=0) as file_out:
+                RetryPolicy.check_status(response.status_code)
                 response.raise_for_status()
-
-                for chunk in response.iter_content(MiaoshouFileDownloader.CHUNK_SIZE):
-                    file_out.write(chunk)
-                    progressbar.update(len(chunk))
-                    self.update_progress(len(chunk))
+                with self.watch_connection(response) as connection:
+                    receive_buffer = ReceiveBuffer(MiaoshouFileDownloader.CHUNK_SIZE)
+                    body = body_stream(response.raw)
+                    offset = 0
+                    while True:
+                        chunk = receive_buffer.readinto(body)
+                        if len(chunk) == 0:
+                            break
+                        write_at(file_out.fileno(), chunk, offset)
+                        offset += len(chunk)
+                        hasher.update(chunk, hasher.offset)
+                        progressbar.update(len(chunk))
+                        self.update_progress(len(chunk))
+                        connection.checkpoint(len(chunk))
+                    file_out.truncate(offset)
+        except (TransferInterrupted, FatalTransferError):
+            raise
         except Exception as ex:
             self.logger.error(f"Download error: {ex}")
+            self.on_transfer_error(ex)
             return None
 
-        # it's time to start to calculate hash since the file is downloaded successfully
-        return ResumeCheckpoint.calculate_hash_of_file(local_filepath)
+        # bytes are hashed while they are written, nothing is left to read back
+        return hasher.hexdigest()
 
     def download_file_resumable(self, target_url: str, local_filepath: str) -> t.Optional[str]:
-        # Always go off the checkpoint as the file was flushed before writing.
+        # Always go off the checkpoint as the journal never gets ahead of the file.
+        content_length = int(self.content_length)
         download_checkpoint = local_filepath + ".downloading"
-        try:
-            assert os.path.exists(local_filepath)  # catch checkpoint without file
-
-            resume_point = ResumeCheckpoint.load_resume_checkpoint(download_checkpoint)
+        segments = None
+        if os.path.exists(local_filepath):  # catch checkpoint without file
+            segments = CheckpointJournal.load(download_checkpoint, content_length)
+        if segments is None or len(segments) != 1:
+            self.logger.warn(f"no downloading checkpoint to resume - {download_checkpoint}")
+            segments = [[0, content_length, 0]]
+            toolkit.preallocate_file(local_filepath, content_length)
+        else:
             self.logger.info("File already exists, resuming download.")
-        except Exception as e:
-            self.logger.warn(f"failed to load downloading checkpoint - {download_checkpoint} {e}")
-            resume_point = 0
-            if os.path.exists(local_filepath):
-                os.remove(local_filepath)
-            Path(local_filepath).touch()
 
+        journal = CheckpointJournal(download_checkpoint, local_filepath, segments)
+        journal.commit()
+        resume_point = segments[0][2]
         assert (resume_point < self.content_length)
 
-        self.finished_chunk_size = resume_point
+        self.finished_chunk_size = 0
+
+        # the prefix from an earlier attempt is hashed once, the rest while it arrives
+        hasher = StreamingHasher(local_filepath)
+        try:
+            hasher.catch_up(resume_point)
+        except Exception as ex:
+            self.logger.error(f"failed to hash downloaded prefix of {local_filepath}: {ex}")
+            journal.remove()
+            return None
 
         # Support resuming
         headers = {"Range": f"bytes={resume_point}-", "Accept-Encoding": "identity"}
         try:
             with tqdm(total=self.content_length, unit="byte", unit_scale=1, colour="GREEN",
                       desc=os.path.basename(self.local_file)) as progressbar, \
-                    self.session.get(target_url, headers=headers, stream=True, timeout=5) as response, \
-                    open(local_filepath, 'r+b') as file_out:
+                    self.session.get(target_url, headers=headers, stream=True) as response, \
+                    open(local_filepath, 'r+b', buffering=0) as file_out:
+                RetryPolicy.check_status(response.status_code)
                 response.raise_for_status()
-                self.update_progress(resume_point)
-                file_out.seek(resume_point)
-
-                for chunk in response.iter_content(MiaoshouFileDownloader.CHUNK_SIZE):
-                    file_out.write(chunk)
-                    file_out.flush()
-                    resume_point += len(chunk)
-                    progressbar.update(len(chunk))
-                    self.update_progress(len(chunk))
-                    ResumeCheckpoint.store_resume_checkpoint(resume_point, download_checkpoint)
-
-                # Only remove checkpoint at full size in case connection cut
-                if os.path.getsize(local_filepath) == self.content_length:
-                    os.remove(download_checkpoint)
-                else:
-                    return None
+                with self.watch_connection(response) as connection:
+                    self.update_progress(resume_point)
+
+                    receive_buffer = ReceiveBuffer(MiaoshouFileDownloader.CHUNK_SIZE)
+                    body = body_stream(response.raw)
+                    while resume_point < content_length:
+                        chunk = receive_buffer.readinto(body, content_length - resume_point)
+                        if len(chunk) == 0:
+                            break
+                        write_at(file_out.fileno(), chunk, resume_point)
+                        hasher.update(chunk, resume_point)
+                        resume_point += len(chunk)
+                        segments[0][2] = resume_point
+                        progressbar.update(len(chunk))
+                        self.update_progress(len(chunk))
+                        journal.advance(len(chunk))
+                        connection.checkpoint(len(chunk))
+
+            # Only remove checkpoint at full size in case connection cut
+            if resume_point == content_length:
+                journal.remove()
+            else:
+                journal.commit()
+                return None
 
+        except (TransferInterrupted, FatalTransferError):
+            journal.commit()
+            raise
         except Exception as ex:
             self.logger.error(f"Download error: {ex}")
+            self.on_transfer_error(ex)
+            journal.commit()
             return None
 
-        return ResumeCheckpoint.calculate_hash_of_file(local_filepath)
+        return hasher.hexdigest()
 
-    def update_progress(self, finished_chunk_size: int) -> None:
-        self.finished_chunk_size += finished_chunk_size
+    def download_file_segmented(self, target_url: str, local_filepath: str) -> t.Optional[str]:
+        """
+        fetch byte ranges of the file over several connections at once, every range is written into
+        its own offset of the preallocated file, and resumed from where it stopped on the next attempt,
+        each connection claims the next range in file order once it is done with one
+        """
+        if not self.accept_ranges:
+            # ranges turned out to be unsupported by an earlier attempt
+            return self.download_file_full(target_url, local_filepath)
 
-        if self.channel:
-            self.channel.put_nowait((
-                self.target_url,
-                self.finished_chunk_size,
-                self.content_length,
-            ))
+        download_checkpoint = local_filepath + ".downloading"
+        content_length = int(self.content_length)
+
+        segments = None
+        if os.path.exists(local_filepath) and os.path.getsize(local_filepath) == content_length:
+            segments = CheckpointJournal.load(download_checkpoint, content_length)
+        if segments is None:
+            segments = self.split_segments(content_length)
+            toolkit.preallocate_file(local_filepath, content_length)
+        else:
+            self.logger.info("File already exists, resuming segmented download.")
+        book = SegmentBook(segments, CheckpointJournal(download_checkpoint, local_filepath, segments),
+                           local_filepath)
+        book.commit()
+
+        self.finished_chunk_size = 0
+        self.update_progress(book.downloaded_size())
+
+        def on_segment_progress(segment: t.List[int], chunk: bytes, offset: int) -> None:
+            snapshot = book.record(segment, len(chunk))
+            if snapshot is not None:
+                book.commit(snapshot)
+            progressbar.update(len(chunk))
+            self.update_progress(len(chunk))
 
-    # In order to avoid leaving extra garbage meta files behind this
-    # will overwrite any existing files found at local_file. If you don't want this
-    # behaviour you can handle this externally.
-    # local_file and local_directory could write to unexpected places if the source
-    # is untrusted, be careful!
-    def download_file(self) -> bool:
-        success = False
         try:
-            print(f"\n\n🚀 miaoshou-assistant downloader: start to download {self.target_url}")
-            self.logger.info(f"miaoshou-assistant downloader: start to download {self.target_url}")
-
-            # Need to rebuild local_file_final each time in case of different urls
-            if not self.local_file:
-                specific_local_file = os.path.basename(urlparse(self.target_url).path)
-            else:
-                specific_local_file = self.local_file
-
-            download_temp_dir = toolkit.get_user_temp_dir()
-            toolkit.assert_user_temp_dir()
-
-            if self.local_directory:
-                os.makedirs(self.local_directory, exist_ok=True)
-
-            specific_local_file = os.path.join(download_temp_dir, specific_local_file)
-
-            self.accept_ranges, self.content_length = self.get_file_info_from_server(self.target_url)
-            self.logger.info(f"Accept-Ranges: {self.accept_ranges}. content length: {self.content_length}")
-            if self.accept_ranges and self.content_length:
-                download_method = self.download_file_resumable
-                self.logger.info("Server supports resume")
-            else:
-                download_method = self.download_file_full
-                self.logger.info(f"Server doesn't support resume.")
-
-            for i in range(self.max_retries):
-                self.logger.info(f"Download Attempt {i + 1}")
-                checksum = download_method(self.target_url, specific_local_file)
-                if checksum:
-                    if self.expected_checksum and self.expected_checksum != checksum:
-                        self.logger.info(f"Checksum doesn't match. Calculated {checksum} "
-                                         f"Expecting: {self.expected_checksum}")
-                    else:
-                        self.logger.info(f"Download successful, Checksum Matched. Checksum {checksum}")
-                        success = True
-                        break
-                time.sleep(1)
-
-            if success:
-                print(f"\n\n🎉 miaoshou-assistant downloader: {self.target_url} [download completed]")
-                self.logger.info(f"{self.target_url} [DOWNLOADED COMPLETELY]")
-                if self.local_directory:
-                    target_local_file = os.path.join(self.local_directory, self.local_file)
-                else:
-                    target_local_file = self.local_file
-                toolkit.move_file(specific_local_file, target_local_file)
-            else:
-                print(f"\n\n😭 miaoshou-assistant downloader: {self.target_url} [download failed]")
-                self.logger.info(f"{self.target_url} [  FAILED  ]")
-
-        except Exception as ex:
-            print(f"\n\n😭 miaoshou-assistant downloader: download failed with unexpected error: {ex}")
-            self.logger.error(f"Unexpected Error: {ex}")  # Only from block above
-
+            workers = max(1, min(MiaoshouFileDownloader.SEGMENT_COUNT, len(book.unfinished())))
+            with tqdm(total=content_length, initial=self.finished_chunk_size, unit="byte", unit_scale=1,
+                      colour="GREEN", desc=os.path.basename(self.local_file)) as progressbar, \
+                    ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(self.download_segments, target_url, local_filepath, book,
+                                           on_segment_progress)
+                           for _ in range(workers)]
+                results = [f.result() for f in futures]
+
+            if not all(results) or os.path.getsize(local_filepath) != content_length:
+                book.commit()
+                return None
+
+            book.journal.remove()
+            return book.hexdigest(content_length)
+        except (TransferInterrupted, FatalTransferError):
+            book.commit()
+            raise
+        except RangeNotSatisfiedError as ex:
+            self.logger.warn(f"{ex}, fall back to a single stream")
+            book.journal.remove()
+            if os.path.exists(local_filepath):
+                os.remove(local_filepath)
+            self.accept_ranges = False
+        finally:
+            book.close()
+        return self.download_file_full(target_url, local_filepath)
+
+    def download_segments(self, target_url: str, local_filepath: str, book: SegmentBook,
+                          on_progress: t.Callable[[t.List[int], bytes, int], None]) -> bool:
+        """
+        one connection, it fetches claimed segments until none is left or one of them fails
+        """
+        while True:
+            segment = book.claim()
+            if segment is None:
+                return True
+            if not self.download_segment(target_url, local_filepath, segment, on_progress):
+                # left claimed, the attempt fails once the other connections are done
+                return False
+            book.release(segment)
+
+    def download_segment(self, target_url: str, local_filepath: str, segment: t.List[int],
+                         on_progress: t.Callable[[t.List[int], bytes, int], None]) -> bool:
+        start, end, _ = segment
+        for i in range(MiaoshouFileDownloader.SEGMENT_RETRIES):
+            offset = start + segment[2]
+            if offset >= end:
+                return True
+
+            headers = {"Range": f"bytes={offset}-{end - 1}", "Accept-Encoding": "identity"}
+            try:
+                with self.session.get(target_url, headers=headers, stream=True) as response, \
+                        open(local_filepath, 'r+b', buffering=0) as file_out:
+                    RetryPolicy.check_status(response.status_code)
+                    response.raise_for_status()
+                    if response.status_code != 206:
+                        raise RangeNotSatisfiedError(f"server ignores range requests of {target_url}")
+                    with self.watch_connection(response) as connection:
+                        receive_buffer = ReceiveBuffer(MiaoshouFileDownloader.CHUNK_SIZE)
+                        body = body_stream(response.raw)
+                        while offset < end:
+                            chunk = receive_buffer.readinto(body, end - offset)
+                            if len(chunk) == 0:
+                                break
+                            # unbuffered, the hasher may read these bytes back through another handle right away
+                            write_at(file_out.fileno(), chunk, offset)
+                            on_progress(segment, chunk, offset)
+                            offset += len(chunk)
+                            connection.checkpoint(len(chunk))
+            except (RangeNotSatisfiedError, TransferInterrupted, FatalTransferError):
+                raise
+            except Exception as ex:
+                # stalled or broken, the segment is requested again from where it stopped
+                self.logger.error(f"Segment [{start}, {end}) download error (attempt {i + 1}): {ex}")
+                self.on_transfer_error(ex, reconnect=True)
+                self.control.wait(RetryPolicy.backoff(i))
+
+        return start + segment[2] >= end
+
+    @staticmethod
+    def drop_connection(response: t.Any) -> None:
+        """
+        shut the socket of response down, unlike closing it this wakes up a read blocked on it in another thread
+        """
+        raw = response.raw
+        sock = getattr(getattr(raw, "_connection", None), "sock", None)
+        if sock is None:
+            # the socket file below the http.client response
+            sock = getattr(getattr(getattr(getattr(raw, "_fp", None), "fp", None), "raw", None), "_sock", None)
+        if sock is not None:
+            sock.shutdown(socket.SHUT_RDWR)
+        else:
+            response.close()
+
+    def watch_connection(self, response: t.Any) -> ConnectionMeter:
+        return self.control.connection(lambda: MiaoshouFileDownloader.drop_connection(response))
+
+    def transfer(self, local_filepath: str) -> t.Optional[str]:
+        if self.accept_ranges and self.content_length \
+                and self.content_length >= 2 * MiaoshouFileDownloader.SEGMENT_SIZE:
+            self.logger.info("Server supports ranges, download in segments")
+            return self.download_file_segmented(self.target_url, local_filepath)
+        elif self.accept_ranges and self.content_length:
+            self.logger.info("Server supports resume")
+            return self.download_file_resumable(self.target_url, local_filepath)
+        else:
+            self.logger.info(f"Server doesn't support resume.")
+            return self.download_file_full(self.target_url, local_filepath)
+
+    def run_step(self, step: str, *args) -> t.Any:
+        if step == MiaoshouFileDownloader.STEP_PROBE:
+            return self.get_file_info_from_server(self.target_url)
+        elif step == MiaoshouFileDownloader.STEP_WAIT:
+            return self.control.wait(*args)
+        elif step == MiaoshouFileDownloader.STEP_TRANSFER:
+            return self.transfer(*args)
+        else:
+            function, *function_args = args
+            return function(*function_args)
 
-        return success
+    def download_file(self) -> bool:
+        steps = self.download_steps()
+        result, error = None, None
+        while True:
+            try:
+                step = steps.send(result) if error is None else steps.throw(error)
+            except StopIteration as stop:
+                return stop.value
+            result, error = None, None
+            try:
+                result = self.run_step(*step)
+            except Exception as ex:
+                error = ex
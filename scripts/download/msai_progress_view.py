@@ -0,0 +1,110 @@
+import html
+import time
+import typing as t
+
+import scripts.msai_utils.msai_toolkit as toolkit
+
+
+class TaskSnapshot(t.NamedTuple):
+    local_file: str
+    state: str
+    downloaded_size: float
+    total_size: float
+    estimated_size: float
+    attempts: int = 0
+    last_error: t.Optional[str] = None
+
+
+class DownloadProgressView(object):
+    """
+    render snapshots of the downloader manager into html for a streaming status handler,
+    one view per stream as it keeps throughput samples and rendered rows between snapshots
+    """
+    # weight of the latest throughput sample
+    SMOOTHING = 0.3
+    STATE_STYLES = {
+        "queued": "color:gray",
+        "running": "color:blue",
+        "paused": "color:orange",
+        "cancelled": "color:gray",
+        "finished": "color:green",
+        "satisfied locally": "color:green",
+        "failed": "color:red",
+    }
+
+    def __init__(self) -> None:
+        # url -> (time, downloaded size, bytes per second)
+        self._rates: t.Dict[str, t.Tuple[float, float, float]] = {}
+        # url -> (row key, rendered row)
+        self._rows: t.Dict[str, t.Tuple[t.Tuple[t.Any, ...], str]] = {}
+
+    def _update_rate(self, url: str, task: TaskSnapshot, now: float) -> float:
+        if task.state != "running":
+            self._rates.pop(url, None)
+            return 0.
+
+        if url not in self._rates:
+            self._rates[url] = (now, task.downloaded_size, 0.)
+            return 0.
+
+        last_time, last_size, speed = self._rates[url]
+        if now - last_time > 0.:
+            sample = max(0., task.downloaded_size - last_size) / (now - last_time)
+            speed = sample if speed == 0. else speed + DownloadProgressView.SMOOTHING * (sample - speed)
+            self._rates[url] = (now, task.downloaded_size, speed)
+        return speed
+
+    @staticmethod
+    def _render_row(task: TaskSnapshot, speed: float) -> str:
+        total_size = task.total_size if task.total_size and task.total_size > 0 else task.estimated_size
+        # the catalog says "unknown" for files without a size
+        total_size = total_size if isinstance(total_size, (int, float)) else None
+        style = DownloadProgressView.STATE_STYLES.get(task.state, "")
+        row = f"<p>{task.local_file} ({toolkit.get_readable_size(total_size) or 'unknown size'}) : "
+
+        if task.state == "running" and total_size:
+            finished_percent = min(100., task.downloaded_size / total_size * 100)
+            row += f'<span style="{style};font-weight:bold">{round(finished_percent, 2)} %</span>'
+            if speed > 0.:
+                eta = max(0., total_size - task.downloaded_size) / speed
+                row += f" {toolkit.get_readable_size(speed)}/s, ETA {time.strftime('%H:%M:%S', time.gmtime(eta))}"
+            if task.attempts > 1:
+                row += f" (attempt {task.attempts})"
+        else:
+            row += f'<span style="{style};font-weight:bold">{task.state}</span>'
+            if task.state == "failed" and task.last_error:
+                row += f" after {task.attempts} attempts, {html.escape(task.last_error)}"
+        return row + "</p>"
+
+    def render(self, snapshot: t.Dict[str, TaskSnapshot]) -> str:
+        now = time.monotonic()
+        counts = {state: 0 for state in DownloadProgressView.STATE_STYLES.keys()}
+
+        rows = []
+        for url, task in snapshot.items():
+            if task.estimated_size is None:
+                # covers are not listed
+                continue
+
+            counts[task.state] = counts.get(task.state, 0) + 1
+            speed = self._update_rate(url, task, now)
+
+            # only rows whose numbers moved are rendered again
+            key = (task.state, task.downloaded_size, task.total_size, round(speed), task.attempts)
+            cached = self._rows.get(url)
+            if cached is None or cached[0] != key:
+                cached = (key, DownloadProgressView._render_row(task, speed))
+                self._rows[url] = cached
+            rows.append(cached[1])
+
+        for url in [u for u in self._rows.keys() if u not in snapshot]:
+            del self._rows[url]
+            self._rates.pop(url, None)
+
+        if len(rows) == 0:
+            return '<div><span>No downloading tasks ongoing</span></div>'
+
+        overall = "<h4>" + ", ".join(
+            f'<span style="{DownloadProgressView.STATE_STYLES[state]};font-weight:bold">{count}</span> {state}'
+            for state, count in counts.items() if count > 0) + ".</h4>"
+        return overall + "<div>" + "".join(rows) + "</div>"
@@ -0,0 +1,87 @@
+import http.client
+import os
+import time
+import typing as t
+
+
+def write_at(fd: int, data: t.Union[bytes, memoryview], offset: int) -> None:
+    """
+    write all of data at offset of fd, without moving or depending on the file position
+    """
+    view = memoryview(data)
+    while len(view) > 0:
+        if hasattr(os, "pwrite"):
+            n = os.pwrite(fd, view, offset)
+        else:
+            # no positional writes on windows, every connection writes through a fd of its own
+            os.lseek(fd, offset, os.SEEK_SET)
+            n = os.write(fd, view)
+        view = view[n:]
+        offset += n
+
+
+def body_stream(raw: t.Any) -> t.Any:
+    """
+    the stream to read the body of the urllib3 response raw from:
+    readinto() of urllib3 goes through read() and copies the result, the http.client response below it
+    reads straight into the buffer. that one is private to urllib3, it is only used while urllib3 has neither
+    to decode the body nor has read from it yet, raw itself otherwise.
+    urllib3 does not count the bytes read past it, the downloaders check the length of what they got themselves
+    """
+    fp = getattr(raw, "_fp", None)
+    headers = getattr(raw, "headers", None) or {}
+    if not isinstance(fp, http.client.HTTPResponse) or getattr(raw, "_fp_bytes_read", 0) != 0 \
+            or headers.get("Content-Encoding", "identity").lower() not in ("identity", ""):
+        return raw
+    return fp
+
+
+class ReceiveBuffer(object):
+    """
+    a receive buffer reused for every read of a transfer, its size follows the observed throughput:
+    it is about what arrives within TARGET_SECONDS, so fast links pay the per-chunk python overhead rarely
+    and a read of a slow one does not block the stall check, pause and cancel for long
+    """
+    MIN_SIZE = 64 * 1024
+    MAX_SIZE = 8 * 1024 * 1024
+    INITIAL_SIZE = 1024 * 1024
+    TARGET_SECONDS = 0.05
+
+    def __init__(self, size: int = INITIAL_SIZE) -> None:
+        self._size = max(ReceiveBuffer.MIN_SIZE, min(ReceiveBuffer.MAX_SIZE, size))
+        # grown on demand, slow transfers never hold the maximum size
+        self._buffer = bytearray(self._size)
+        self._view = memoryview(self._buffer)
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def observe(self, read_size: int, elapsed: float) -> None:
+        if read_size <= 0:
+            return
+        # bytes which would arrive within TARGET_SECONDS at the throughput of this read
+        wanted = read_size / max(elapsed, 1e-6) * ReceiveBuffer.TARGET_SECONDS
+        if wanted >= self._size * 2:
+            self._size = min(ReceiveBuffer.MAX_SIZE, self._size * 2)
+        elif wanted < self._size / 2 and elapsed > ReceiveBuffer.TARGET_SECONDS:
+            self._size = max(ReceiveBuffer.MIN_SIZE, self._size // 2)
+
+    def readinto(self, stream: t.Any, limit: int = None) -> memoryview:
+        """
+        read from a stream supporting readinto(), e.g. body_stream() of the raw response of requests
+        :return:
+            the bytes read, only valid until the next read, empty at the end of the stream
+        """
+        if self._size > len(self._buffer):
+            self._buffer = bytearray(self._size)
+            self._view = memoryview(self._buffer)
+
+        size = self._size if limit is None else min(self._size, limit)
+        start_time = time.monotonic()
+        n = stream.readinto(self._view[:size]) or 0
+        if n == 0 and size > 0 and isinstance(stream, http.client.HTTPResponse) and stream.length:
+            # http.client reports a connection closed early as the end of the body
+            raise http.client.IncompleteRead(b"", stream.length)
+        self.observe(n, time.monotonic() - start_time)
+        return self._view[:n]
@@ -0,0 +1,331 @@
+import asyncio
+import random
+import re
+import time
+import typing as t
+from threading import Condition, Event, Lock, Thread
+
+from scripts.msai_utils.msai_singleton import MiaoshouSingleton
+
+
+class TransferInterrupted(Exception):
+    """
+    a transfer is paused or cancelled, it is not retried
+    """
+    pass
+
+
+class TransferStalled(Exception):
+    """
+    the transfer rate stays below the stall threshold, the connection is dropped and made again
+    """
+    pass
+
+
+class FatalTransferError(Exception):
+    """
+    retrying cannot help, e.g. the server rejects the token, the task fails right away
+    """
+    pass
+
+
+class RetryPolicy(object):
+    # client errors other than timeouts and rate limits do not go away by asking again
+    FATAL_STATUS = [400, 401, 403, 404, 405, 410, 451]
+    BACKOFF_BASE = 1.
+    BACKOFF_CAP = 60.
+
+    @staticmethod
+    def check_status(status: int) -> None:
+        if status in RetryPolicy.FATAL_STATUS:
+            raise FatalTransferError(f"HTTP {status}")
+
+    @staticmethod
+    def describe(ex: Exception) -> str:
+        # errors quote the url, which may carry the civitai token
+        return re.sub(r"(token=)[^&\s]+", r"\1***", f"{type(ex).__name__}: {ex}")
+
+    @staticmethod
+    def backoff(attempt: int) -> float:
+        """
+        full jitter, so transfers failing together do not come back together
+        :return:
+            seconds to wait before the retry after the attempt-th failure, counting from 0
+        """
+        return random.uniform(0., min(RetryPolicy.BACKOFF_CAP, RetryPolicy.BACKOFF_BASE * 2 ** attempt))
+
+
+class TransferAttempt(object):
+    """
+    one attempt of a transfer, reconnects are the connections made again within it
+    """
+    __slots__ = ("number", "started_time", "finished_time", "downloaded_size", "reconnects", "error")
+
+    def __init__(self, number: int, downloaded_size: int = 0) -> None:
+        self.number = number
+        self.started_time: float = time.time()
+        self.finished_time: t.Optional[float] = None
+        self.downloaded_size = downloaded_size
+        self.reconnects = 0
+        self.error: t.Optional[str] = None
+
+    def finish(self, downloaded_size: int, error: str = None) -> None:
+        self.finished_time = time.time()
+        # a transfer which cannot resume starts over from 0
+        self.downloaded_size = max(0, downloaded_size - self.downloaded_size)
+        self.error = error or self.error
+
+
+class TransferProgress(object):
+    """
+    counters of one transfer, written only by the transfer and read by anyone without locking
+    """
+    __slots__ = ("downloaded_size", "total_size", "updated_time")
+
+    def __init__(self, total_size: float = 0.) -> None:
+        self.downloaded_size: int = 0
+        self.total_size: float = total_size or 0.
+        self.updated_time: float = time.monotonic()
+
+    def update(self, downloaded_size: int, total_size: float) -> None:
+        self.total_size = total_size
+        self.downloaded_size = downloaded_size
+        self.updated_time = time.monotonic()
+
+
+class BandwidthLimiter(object):
+    """
+    token bucket shared by any number of transfers and threads, a rate of 0 means unlimited
+    """
+    def __init__(self, bytes_per_second: float = 0., burst_seconds: float = 1.) -> None:
+        self._mutex = Lock()
+        self._rate = 0.
+        self._burst_seconds = burst_seconds
+        self._tokens = 0.
+        self._last_time = time.monotonic()
+        self.rate = bytes_per_second
+
+    @property
+    def rate(self) -> float:
+        return self._rate
+
+    @rate.setter
+    def rate(self, bytes_per_second: float) -> None:
+        with self._mutex:
+            self._rate = max(0., float(bytes_per_second or 0.))
+            self._tokens = min(self._tokens, self._rate * self._burst_seconds)
+            self._last_time = time.monotonic()
+
+    def consume(self, size: int) -> float:
+        """
+        take size bytes out of the bucket
+        :return:
+            seconds the caller should wait before it transfers any more bytes
+        """
+        with self._mutex:
+            if self._rate <= 0.:
+                return 0.
+
+            now = time.monotonic()
+            self._tokens = min(self._tokens + (now - self._last_time) * self._rate,
+                               self._rate * self._burst_seconds)
+            self._last_time = now
+            # the bucket goes into debt, whoever takes the last tokens waits for them to be refilled
+            self._tokens -= size
+            return -self._tokens / self._rate if self._tokens < 0. else 0.
+
+
+class ConnectionMeter(object):
+    """
+    throughput of one connection of a transfer, checked by the StallWatchdog on a timer rather than as bytes
+    arrive, so a connection which delivers nothing at all is caught as well as a slow one. once it is stalled,
+    on_stall is called from the watchdog thread to drop the connection, e.g. to close the response,
+    and the transfer raises TransferStalled.
+    used as a context manager around reading a response, chunks go through its checkpoints
+    """
+    def __init__(self, control: "TransferControl", on_stall: t.Callable[[], None] = None) -> None:
+        self._control = control
+        self._on_stall = on_stall
+        self._mutex = Lock()
+        self._window_start = time.monotonic()
+        self._window_bytes = 0
+        self._window_throttled = 0.
+        self._stalled: t.Optional[str] = None
+
+    def __enter__(self) -> "ConnectionMeter":
+        # time spent queued, connecting or backing off is not a stall, the window starts once it is connected
+        with self._mutex:
+            self._window_start = time.monotonic()
+        StallWatchdog().register(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        StallWatchdog().unregister(self)
+        if self._stalled is not None and exc_type not in (TransferInterrupted, FatalTransferError):
+            # whatever dropping the connection made the read fail with, or the end of a cut short body
+            raise TransferStalled(self._stalled) from exc_value
+
+    def _record(self, size: int, delay: float) -> None:
+        with self._mutex:
+            self._window_bytes += size
+            self._window_throttled += delay
+        if self._stalled is not None:
+            raise TransferStalled(self._stalled)
+
+    def check(self, now: float) -> None:
+        """
+        called by the watchdog
+        """
+        with self._mutex:
+            if self._stalled is not None:
+                return
+            active_seconds = now - self._window_start - self._window_throttled
+            if active_seconds < self._control.stall_seconds:
+                return
+            rate = self._window_bytes / active_seconds
+            self._window_start = now
+            self._window_bytes = 0
+            self._window_throttled = 0.
+            if rate >= self._control.stall_bytes_per_second:
+                return
+            self._stalled = f"stalled at {round(rate)} bytes/s for {round(active_seconds)} seconds"
+
+        if self._on_stall is not None:
+            self._on_stall()
+
+    def checkpoint(self, size: int) -> None:
+        delay = self._control.consume(size)
+        self._record(size, delay)
+        if delay > 0.:
+            time.sleep(delay)
+
+    async def async_checkpoint(self, size: int) -> None:
+        delay = self._control.consume(size)
+        self._record(size, delay)
+        if delay > 0.:
+            await asyncio.sleep(delay)
+
+
+class StallWatchdog(metaclass=MiaoshouSingleton):
+    """
+    one thread checking every open connection of every transfer each INTERVAL seconds
+    """
+    INTERVAL = 1.
+
+    def __init__(self) -> None:
+        # guard against the singleton calling __init__ again
+        if hasattr(self, "_condition"):
+            return
+
+        self._condition = Condition()
+        self._meters: t.Set[ConnectionMeter] = set()
+        self._thread: t.Optional[Thread] = None
+
+    def register(self, meter: ConnectionMeter) -> None:
+        with self._condition:
+            self._meters.add(meter)
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name="msai_stall_watchdog", daemon=True)
+                self._thread.start()
+            self._condition.notify_all()
+
+    def unregister(self, meter: ConnectionMeter) -> None:
+        with self._condition:
+            self._meters.discard(meter)
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                while len(self._meters) == 0:
+                    self._condition.wait()
+                self._condition.wait(StallWatchdog.INTERVAL)
+                meters = list(self._meters)
+
+            now = time.monotonic()
+            for meter in meters:
+                try:
+                    meter.check(now)
+                except Exception:
+                    # dropping a connection which is already gone
+                    pass
+
+
+class TransferControl(object):
+    """
+    handed to a downloader by the manager, checked after every chunk to apply bandwidth limits
+    and to stop the transfer once it is paused or cancelled, every connection is watched for a stall
+    by a ConnectionMeter of its own
+    """
+    # a connection slower than this for STALL_SECONDS is stalled, time spent on bandwidth limits is not counted
+    STALL_BYTES_PER_SECOND = 16 * 1024
+    STALL_SECONDS = 30.
+    WAIT_STEP = 0.5
+
+    def __init__(self, limiters: t.List[BandwidthLimiter] = None,
+                 stall_bytes_per_second: float = STALL_BYTES_PER_SECOND, stall_seconds: float = STALL_SECONDS) -> None:
+        self._limiters = limiters or []
+        self._paused = Event()
+        self._cancelled = Event()
+
+        self.stall_bytes_per_second = stall_bytes_per_second
+        self.stall_seconds = stall_seconds
+
+    @property
+    def limiters(self) -> t.List[BandwidthLimiter]:
+        return self._limiters
+
+    def pause(self) -> None:
+        self._paused.set()
+
+    def resume(self) -> None:
+        self._paused.clear()
+
+    def cancel(self) -> None:
+        self._cancelled.set()
+
+    def is_paused(self) -> bool:
+        return self._paused.is_set()
+
+    def is_cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def _check_interrupted(self) -> None:
+        if self._cancelled.is_set():
+            raise TransferInterrupted("cancelled")
+        if self._paused.is_set():
+            raise TransferInterrupted("paused")
+
+    def consume(self, size: int) -> float:
+        """
+        :return:
+            seconds to wait for the bandwidth limits before any more bytes are transferred
+        """
+        self._check_interrupted()
+        return max([limiter.consume(size) for limiter in self._limiters] or [0.])
+
+    def connection(self, on_stall: t.Callable[[], None] = None) -> ConnectionMeter:
+        """
+        :param on_stall: drops the connection, called from another thread
+        """
+        return ConnectionMeter(self, on_stall)
+
+    def wait(self, seconds: float) -> None:
+        """
+        sleep before a retry, it is cut short by a pause or a cancel
+        """
+        deadline = time.monotonic() + seconds
+        while True:
+            self._check_interrupted()
+            remaining = deadline - time.monotonic()
+            if remaining <= 0.:
+                return
+            time.sleep(min(remaining, TransferControl.WAIT_STEP))
+
+    async def async_wait(self, seconds: float) -> None:
+        deadline = time.monotonic() + seconds
+        while True:
+            self._check_interrupted()
+            remaining = deadline - time.monotonic()
+            if remaining <= 0.:
+                return
+            await asyncio.sleep(min(remaining, TransferControl.WAIT_STEP))
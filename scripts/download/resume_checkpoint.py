@@ -1,51 +1,34 @@
 import os
 import pathlib
 import glob
-import pickle
+import time
 import typing as t
 from hashlib import sha256
+from threading import Condition, Thread
 
 from scripts.msai_logging.msai_logger import Logger
+from scripts.msai_utils import msai_toolkit as toolkit
 
 logger = Logger()
 
 
 class ResumeCheckpoint(object):
     VERSION_FILENAME = ".version"
-    VERSION = "version 2.0"
-
-    @staticmethod
-    def load_resume_checkpoint(filename: str) -> int:
-        resume_point = 0
-        try:
-            # get resume_point from foobar.downloading file
-            with open(filename, "rb") as file:
-                resume_point = pickle.load(file)
-        except Exception as ex:
-            logger.error(f"load_resume_checkpoint err: {ex}")
-        finally:
-            return resume_point
-
-    @staticmethod
-    def store_resume_checkpoint(resume_point: int, filename: str) -> bool:
-        try:
-            with open(filename, "wb") as file:
-                pickle.dump(resume_point, file)
-                return True
-        except Exception as ex:
-            logger.error(f"store_resume_checkpoint err: {ex}")
-            return False
+    VERSION = "version 3.0"
 
     @staticmethod
     def cleanup_checkpoints_if_needed(checkpoint_folder: str) -> None:
         version_file = os.path.join(checkpoint_folder, ResumeCheckpoint.VERSION_FILENAME)
         if os.path.isfile(version_file):
-            logger.info(f"already {ResumeCheckpoint.VERSION}")
-            return
+            version_info = toolkit.read_json(version_file)
+            if isinstance(version_info, dict) and version_info.get("version") == ResumeCheckpoint.VERSION:
+                logger.info(f"already {ResumeCheckpoint.VERSION}")
+                return
 
-        for file in glob.glob(os.path.join(checkpoint_folder, "*.downloading")):
-            print(f"delete checkpoint file with old version: {file}")
-            os.remove(file)
+        for pattern in ["*.downloading", "*.segments"]:
+            for file in glob.glob(os.path.join(checkpoint_folder, pattern)):
+                print(f"delete checkpoint file with old version: {file}")
+                os.remove(file)
 
     @staticmethod
     def store_version_info(checkpoint_folder: str) -> bool:
@@ -75,3 +58,201 @@ class ResumeCheckpoint(object):
         except Exception:
             return None
 
+
+class CheckpointJournal(object):
+    """
+    progress of a download as [start, end, downloaded size] per segment, persisted to <file>.downloading.
+    writes are coalesced by time and bytes, the data file is fsync-ed before every write,
+    so the journal never claims bytes which are not on disk yet
+    """
+    INTERVAL = 2.
+    BYTES = 64 * 1024 * 1024
+
+    def __init__(self, filename: str, data_file: str, segments: t.List[t.List[int]]) -> None:
+        self._filename = filename
+        self._data_file = data_file
+        self._segments = segments
+        self._pending_bytes = 0
+        self._last_commit_time = 0.
+
+    @property
+    def segments(self) -> t.List[t.List[int]]:
+        return self._segments
+
+    @staticmethod
+    def load(filename: str, content_length: int) -> t.Optional[t.List[t.List[int]]]:
+        """
+        :return:
+            segments of the journal, None if it is missing, of another version or not for this length
+        """
+        if not os.path.isfile(filename):
+            return None
+
+        journal = toolkit.read_json(filename)
+        try:
+            if journal["version"] != ResumeCheckpoint.VERSION or journal["length"] != content_length:
+                return None
+            segments = [[int(start), int(end), int(done)] for start, end, done in journal["segments"]]
+            if sum(end - start for start, end, _ in segments) != content_length:
+                return None
+            return segments
+        except Exception as ex:
+            logger.error(f"load checkpoint journal {filename} err: {ex}")
+            return None
+
+    def record(self, size: int) -> bool:
+        """
+        :return:
+            True if a commit is due, for callers which would rather commit off their own thread
+        """
+        self._pending_bytes += size
+        return self._pending_bytes >= CheckpointJournal.BYTES \
+            or time.monotonic() - self._last_commit_time >= CheckpointJournal.INTERVAL
+
+    def advance(self, size: int) -> None:
+        if self.record(size):
+            self.commit()
+
+    def commit(self, segments: t.List[t.List[int]] = None) -> bool:
+        """
+        :param segments: a snapshot taken by the caller if segments keep changing during the commit
+        """
+        segments = self._segments if segments is None else segments
+        try:
+            # fsync point: data first, then the journal which refers to it
+            fd = os.open(self._data_file, os.O_RDWR)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+            journal = {
+                "version": ResumeCheckpoint.VERSION,
+                "length": sum(end - start for start, end, _ in segments),
+                "segments": segments,
+            }
+            if not toolkit.write_json_atomic(self._filename, journal, indent=None):
+                return False
+        except Exception as ex:
+            logger.error(f"commit checkpoint journal {self._filename} err: {ex}")
+            return False
+
+        self._pending_bytes = 0
+        self._last_commit_time = time.monotonic()
+        return True
+
+    def remove(self) -> None:
+        if os.path.exists(self._filename):
+            os.remove(self._filename)
+
+
+class StreamingHasher(object):
+    """
+    sha256 of a file being downloaded, bytes are hashed in file order as they arrive,
+    bytes already on disk (a resumed prefix, ranges written by other connections) are read back once
+    """
+    BUFFER_SIZE = 8 * 1024 * 1024
+
+    def __init__(self, filepath: str) -> None:
+        self._filepath = filepath
+        self._hasher = sha256()
+        self._offset = 0
+
+    @property
+    def offset(self) -> int:
+        return self._offset
+
+    def update(self, data: bytes, offset: int) -> bool:
+        """
+        :return:
+            False if data does not start at the hashed offset, it is left to catch_up then
+        """
+        if offset != self._offset:
+            return False
+        self._hasher.update(data)
+        self._offset += len(data)
+        return True
+
+    def catch_up(self, end: int) -> None:
+        if end <= self._offset:
+            return
+
+        buffer = bytearray(min(StreamingHasher.BUFFER_SIZE, end - self._offset))
+        view = memoryview(buffer)
+        with open(self._filepath, "rb") as file:
+            file.seek(self._offset)
+            while self._offset < end:
+                n = file.readinto(view[:min(len(buffer), end - self._offset)])
+                if not n:
+                    raise EOFError(f"{self._filepath} is shorter than {end} bytes")
+                self._hasher.update(view[:n])
+                self._offset += n
+
+    def hexdigest(self) -> str:
+        return self._hasher.hexdigest()
+
+
+class BackgroundHasher(object):
+    """
+    sha256 of a file written out of order, a thread of its own reads back and hashes the file up to the end
+    of the contiguous prefix reported by the writers, so neither they nor an event loop ever wait for hashing
+    """
+    # bytes hashed between checks for close()
+    STEP_SIZE = 64 * 1024 * 1024
+
+    def __init__(self, filepath: str, end: int = 0) -> None:
+        self._hasher = StreamingHasher(filepath)
+        self._condition = Condition()
+        self._end = end
+        self._closed = False
+        self._error: t.Optional[Exception] = None
+        self._thread = Thread(target=self._run, name="msai_download_hash", daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        try:
+            while True:
+                with self._condition:
+                    while not self._closed and self._end <= self._hasher.offset:
+                        self._condition.wait()
+                    if self._closed:
+                        return
+                    end = min(self._end, self._hasher.offset + BackgroundHasher.STEP_SIZE)
+                # only this thread touches the hasher
+                self._hasher.catch_up(end)
+                with self._condition:
+                    self._condition.notify_all()
+        except Exception as ex:
+            with self._condition:
+                self._error = ex
+                self._condition.notify_all()
+
+    def advance(self, end: int) -> None:
+        """
+        bytes up to end are on disk, cheap enough to be called for every chunk
+        """
+        with self._condition:
+            if end > self._end:
+                self._end = end
+                self._condition.notify_all()
+
+    def finish(self, end: int) -> str:
+        """
+        block until the file is hashed up to end
+        :return:
+            sha256 of the first end bytes
+        """
+        self.advance(end)
+        with self._condition:
+            while self._error is None and self._hasher.offset < end:
+                self._condition.wait()
+            self._closed = True
+            self._condition.notify_all()
+            if self._error is not None:
+                raise self._error
+        return self._hasher.hexdigest()
+
+    def close(self) -> None:
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
@@ -1 +1 @@
-__all__ = ["msai_singleton", "msai_toolkit"]
+__all__ = ["msai_http", "msai_json_file", "msai_singleton", "msai_toolkit"]
@@ -0,0 +1,75 @@
+import typing as t
+from http.cookiejar import DefaultCookiePolicy
+from threading import Lock
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+
+from scripts.msai_utils.msai_singleton import MiaoshouSingleton
+
+
+class MiaoshouHttpClient(metaclass=MiaoshouSingleton):
+    """
+    one requests session shared by the runtime and the downloaders, so calls to the same host reuse
+    kept-alive connections instead of paying a tcp and tls handshake each time,
+    every request gets the same timeouts and retry policy unless the caller asks otherwise
+    """
+    CONNECT_TIMEOUT = 10.
+    READ_TIMEOUT = 30.
+    # hosts with a connection pool of their own, the least recently used one is closed beyond that
+    POOL_CONNECTIONS = 10
+    # connections kept alive per host, enough for every segment of max_concurrent_downloads transfers
+    POOL_MAXSIZE = 16
+
+    def __init__(self) -> None:
+        # guard against the singleton calling __init__ again
+        if hasattr(self, "_mutex"):
+            return
+
+        self._mutex = Lock()
+        self._session: t.Optional[requests.Session] = None
+
+    @staticmethod
+    def _create_session() -> requests.Session:
+        retry_strategy = Retry(
+            total=3,
+            backoff_factor=1,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=["HEAD", "GET", "OPTIONS"]
+        )
+        # pool_block is off, a thread finding the pool empty opens an extra connection rather than waiting
+        adapter = HTTPAdapter(pool_connections=MiaoshouHttpClient.POOL_CONNECTIONS,
+                              pool_maxsize=MiaoshouHttpClient.POOL_MAXSIZE,
+                              max_retries=retry_strategy)
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        # the session is shared across threads and tasks, requests must not depend on each other's cookies
+        session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        return session
+
+    @property
+    def session(self) -> requests.Session:
+        with self._mutex:
+            if self._session is None:
+                self._session = MiaoshouHttpClient._create_session()
+            return self._session
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        kwargs.setdefault("timeout", (MiaoshouHttpClient.CONNECT_TIMEOUT, MiaoshouHttpClient.READ_TIMEOUT))
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def head(self, url: str, **kwargs) -> requests.Response:
+        # unlike requests.head, redirects are followed unless told otherwise
+        kwargs.setdefault("allow_redirects", True)
+        return self.request("HEAD", url, **kwargs)
+
+    def close(self) -> None:
+        with self._mutex:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
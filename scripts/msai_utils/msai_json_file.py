@@ -0,0 +1,75 @@
+import os
+import typing as t
+from threading import RLock, Timer
+
+from scripts.msai_utils import msai_toolkit as toolkit
+
+
+class ResidentJsonFile(object):
+    """
+    keep the content of a json file in memory, it is reloaded only if the file's mtime changes,
+    and changes are written back in one atomic write after flush_delay seconds of quiet or on flush()
+    """
+    FLUSH_DELAY = 2.
+
+    def __init__(self, file: str, default: t.Callable[[], t.Any] = dict, indent: t.Optional[int] = 4,
+                 flush_delay: float = FLUSH_DELAY) -> None:
+        self._file = file
+        self._default = default
+        self._indent = indent
+        self._flush_delay = flush_delay
+        self._mutex = RLock()
+        self._content: t.Any = None
+        self._mtime: t.Optional[int] = None
+        self._dirty = False
+        self._timer: t.Optional[Timer] = None
+
+    @property
+    def file(self) -> str:
+        return self._file
+
+    @property
+    def mutex(self) -> RLock:
+        """
+        hold it to read-modify-write the content without racing other threads
+        """
+        return self._mutex
+
+    def _get_mtime(self) -> t.Optional[int]:
+        try:
+            return os.stat(self._file).st_mtime_ns
+        except OSError:
+            return None
+
+    def load(self) -> t.Any:
+        with self._mutex:
+            mtime = self._get_mtime()
+            # local changes not written yet win over the file
+            if self._content is None or (not self._dirty and mtime != self._mtime):
+                content = toolkit.read_json(self._file) if mtime is not None else None
+                self._content = content if content is not None else self._default()
+                self._mtime = mtime
+            return self._content
+
+    def mark_dirty(self) -> None:
+        with self._mutex:
+            self._dirty = True
+            if self._timer is not None:
+                self._timer.cancel()
+            self._timer = Timer(self._flush_delay, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def flush(self) -> bool:
+        with self._mutex:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not self._dirty:
+                return True
+
+            if not toolkit.write_json_atomic(self._file, self._content, indent=self._indent):
+                return False
+            self._dirty = False
+            self._mtime = self._get_mtime()
+            return True
@@ -1,3 +1,4 @@
+import errno
 import json
 import os
 import platform
@@ -24,6 +25,24 @@ def write_json(file, content) -> None:
         print(e)
 
 
+def write_json_atomic(file, content, indent=4) -> bool:
+    # write into a sibling temp file then rename it, readers never see a half-written file
+    tmp_file = f"{file}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(file)), exist_ok=True)
+        with open(tmp_file, 'w') as f:
+            json.dump(content, f, indent=indent)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, file)
+        return True
+    except Exception as e:
+        print(e)
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        return False
+
+
 def get_args(args) -> t.List[str]:
     parameters = []
     idx = 0
@@ -74,6 +93,63 @@ def assert_user_temp_dir() -> None:
     os.makedirs(get_user_temp_dir(), exist_ok=True)
 
 
+# a download in progress, the suffix keeps it from being taken for a model or a cover
+STAGING_SUFFIX = ".msai_part"
+
+
+def get_staging_file(target_file: str, staging_dir: str = None) -> str:
+    """
+    where target_file is downloaded before it is renamed into place, always on the device of its folder:
+    in staging_dir if it lives on that device, otherwise next to target_file
+    """
+    target_dir = os.path.dirname(os.path.abspath(target_file))
+    if staging_dir:
+        try:
+            os.makedirs(staging_dir, exist_ok=True)
+            if os.stat(staging_dir).st_dev == os.stat(target_dir).st_dev:
+                return os.path.join(staging_dir, os.path.basename(target_file) + STAGING_SUFFIX)
+        except OSError:
+            pass
+    return os.path.join(target_dir, os.path.basename(target_file) + STAGING_SUFFIX)
+
+
+def get_free_space(path: str) -> int:
+    """
+    free bytes on the device of path, or of its nearest existing parent
+    """
+    path = os.path.abspath(path)
+    while not os.path.exists(path) and os.path.dirname(path) != path:
+        path = os.path.dirname(path)
+    return shutil.disk_usage(path).free
+
+
+def preallocate_file(file: str, size: int) -> None:
+    """
+    create file with size bytes reserved on disk, it is only sparse where the platform cannot reserve space
+    """
+    with open(file, 'wb') as f:
+        if size > 0 and hasattr(os, "posix_fallocate"):
+            try:
+                os.posix_fallocate(f.fileno(), 0, size)
+                return
+            except OSError:
+                pass
+        f.truncate(size)
+
+
+def replace_file(src: str, dst: str) -> None:
+    """
+    rename src over dst atomically, the content is only copied if they turn out to be on different devices
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(dst)), exist_ok=True)
+    try:
+        os.replace(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        move_file(src, dst)
+
+
 def move_file(src: str, dst: str) -> None:
     if not src or not dst:
         return
@@ -86,3 +162,47 @@ def move_file(src: str, dst: str) -> None:
 
     os.makedirs(os.path.dirname(dst), exist_ok=True)
     shutil.move(src, dst)
+
+
+# ioctl request to share the extents of one file with another on btrfs, xfs and other cow filesystems
+FICLONE = 0x40049409
+
+
+def clone_file(src: str, dst: str) -> str:
+    """
+    materialize dst with the content of src, by reflink, hard link or copy, whichever works first
+    :return:
+        "reflink", "hardlink" or "copy"
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(dst)), exist_ok=True)
+    tmp_file = f"{dst}.{os.getpid()}.tmp"
+    if os.path.exists(tmp_file):
+        os.remove(tmp_file)
+
+    method = None
+    try:
+        import fcntl
+        with open(src, 'rb') as f_src, open(tmp_file, 'wb') as f_dst:
+            fcntl.ioctl(f_dst.fileno(), FICLONE, f_src.fileno())
+        method = "reflink"
+    except (ImportError, OSError):
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+    if method is None:
+        try:
+            os.link(src, tmp_file)
+            method = "hardlink"
+        except OSError:
+            pass
+
+    try:
+        if method is None:
+            shutil.copy2(src, tmp_file)
+            method = "copy"
+        os.replace(tmp_file, dst)
+    except Exception:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+    return method
@@ -1,4 +1,4 @@
-__all__ = ["msai_prelude", "msai_runtime"]
+__all__ = ["msai_catalog_index", "msai_hash_engine", "msai_model_watcher", "msai_prelude", "msai_runtime", "msai_scan_cache"]
 
 from . import msai_prelude as prelude
 
@@ -0,0 +1,158 @@
+import atexit
+import copy
+import time
+import typing as t
+from collections import OrderedDict
+from concurrent.futures import Future
+from threading import Lock
+
+from scripts.msai_logging.msai_logger import Logger
+from scripts.msai_utils.msai_http import MiaoshouHttpClient
+from scripts.msai_utils.msai_json_file import ResidentJsonFile
+
+
+class ModelApiCache(object):
+    """
+    cache of json responses of the model api keyed by url, held in a lru in memory and optionally in cache_file,
+    a response younger than ttl seconds is served without asking, an older one is revalidated with its etag,
+    concurrent requests for the same url share one round trip
+    """
+    VERSION = 1
+    TTL = 30 * 60.
+    MAX_MEMORY_ENTRIES = 64
+    MAX_FILE_ENTRIES = 512
+
+    def __init__(self, cache_file: str = None, ttl: float = TTL,
+                 max_memory_entries: int = MAX_MEMORY_ENTRIES, max_file_entries: int = MAX_FILE_ENTRIES) -> None:
+        self.logger = Logger()
+        self._ttl = max(0., ttl)
+        self._max_memory_entries = max_memory_entries
+        self._max_file_entries = max_file_entries
+        self._mutex = Lock()
+        # url -> {"time": fetched or revalidated time, "etag": etag or None, "payload": json}
+        self._entries: t.OrderedDict[str, t.Dict[str, t.Any]] = OrderedDict()
+        self._inflight: t.Dict[str, Future] = {}
+
+        self._file: t.Optional[ResidentJsonFile] = None
+        if cache_file:
+            self._file = ResidentJsonFile(cache_file, default=lambda: {"version": ModelApiCache.VERSION, "entries": {}},
+                                          indent=None)
+            atexit.register(self._file.flush)
+
+    def _file_entries(self) -> t.Optional[t.Dict[str, t.Any]]:
+        if self._file is None:
+            return None
+        content = self._file.load()
+        if not isinstance(content, dict):
+            # not ours, left alone and nothing is persisted
+            return {}
+        if content.get("version") != ModelApiCache.VERSION or not isinstance(content.get("entries"), dict):
+            content.clear()
+            content.update({"version": ModelApiCache.VERSION, "entries": {}})
+        return content["entries"]
+
+    def _lookup(self, url: str) -> t.Optional[t.Dict[str, t.Any]]:
+        with self._mutex:
+            entry = self._entries.get(url)
+            if entry is not None:
+                self._entries.move_to_end(url)
+                return entry
+
+        if self._file is None:
+            return None
+        with self._file.mutex:
+            entry = self._file_entries().get(url)
+        if entry is not None:
+            self._remember(url, entry)
+        return entry
+
+    def _remember(self, url: str, entry: t.Dict[str, t.Any]) -> None:
+        with self._mutex:
+            self._entries[url] = entry
+            self._entries.move_to_end(url)
+            while len(self._entries) > self._max_memory_entries:
+                self._entries.popitem(last=False)
+
+    def _store(self, url: str, entry: t.Dict[str, t.Any]) -> None:
+        self._remember(url, entry)
+        if self._file is None:
+            return
+
+        with self._file.mutex:
+            entries = self._file_entries()
+            entries[url] = entry
+            if len(entries) > self._max_file_entries:
+                oldest = sorted(entries.keys(), key=lambda k: entries[k]["time"])
+                for key in oldest[:len(entries) - self._max_file_entries]:
+                    del entries[key]
+            self._file.mark_dirty()
+
+    def _fetch(self, url: str, entry: t.Optional[t.Dict[str, t.Any]]) -> t.Any:
+        headers = {}
+        if entry is not None and entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+
+        try:
+            response = MiaoshouHttpClient().get(url, headers=headers)
+        except Exception as e:
+            if entry is None:
+                raise
+            # a stale answer beats no answer while the site is unreachable
+            self.logger.warn(f"failed to revalidate {url}, stale response is used: {e}")
+            return entry["payload"]
+
+        if response.status_code == 304 and entry is not None:
+            self._store(url, dict(entry, time=time.time()))
+            return entry["payload"]
+
+        payload = response.json()
+        if response.status_code == 200:
+            self._store(url, {"time": time.time(), "etag": response.headers.get("ETag"), "payload": payload})
+        return payload
+
+    def get_json(self, url: str) -> t.Any:
+        """
+        :return:
+            json of the response to url, callers are free to modify it
+        """
+        entry = self._lookup(url)
+        if entry is not None and time.time() - entry["time"] < self._ttl:
+            return copy.deepcopy(entry["payload"])
+
+        with self._mutex:
+            future = self._inflight.get(url)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._inflight[url] = future
+
+        if owner:
+            try:
+                future.set_result(self._fetch(url, entry))
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                with self._mutex:
+                    self._inflight.pop(url, None)
+
+        return copy.deepcopy(future.result())
+
+    def invalidate(self, url: str = None) -> None:
+        """
+        drop the response of url, or every response if url is None
+        """
+        with self._mutex:
+            if url is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(url, None)
+
+        if self._file is None:
+            return
+        with self._file.mutex:
+            entries = self._file_entries()
+            if url is None:
+                entries.clear()
+            else:
+                entries.pop(url, None)
+            self._file.mark_dirty()
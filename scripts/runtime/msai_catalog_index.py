@@ -0,0 +1,369 @@
+import bisect
+import re
+import typing as t
+
+
+class ModelCatalogIndex(object):
+    """
+    in-memory indexes over one model catalog (the content of a model json file),
+    all positions refer to the order of models inside the catalog list
+    """
+    _WORD = re.compile(r"\w+")
+
+    def __init__(self, models: t.List[t.Dict]) -> None:
+        self._models: t.List[t.Dict] = models if models is not None else []
+
+        # models which are never listed, e.g. without any model file
+        self._unlisted: t.Set[int] = set()
+        # models which cannot be matched by a non-empty search pattern
+        self._unsearchable: t.Set[int] = set()
+        # lower-cased (name, description, first file name) per model
+        self._fields: t.List[t.Tuple[t.Optional[str], ...]] = []
+
+        self._postings: t.Dict[str, t.Set[int]] = {}
+        self._vocabulary: str = ""
+        self._vocabulary_offsets: t.List[int] = []
+        self._tokens: t.List[str] = []
+
+        # facet bitsets, bit N stands for the model at position N
+        self._all_bits: int = 0
+        self._safe_bits: int = 0
+        self._no_base_model_bits: int = 0
+        self._type_bits: t.Dict[t.Any, int] = {}
+        self._base_model_bits: t.Dict[t.Any, int] = {}
+        self._tag_bits: t.Dict[t.Any, int] = {}
+        # facet values which cannot be grouped, evaluated on demand as (position, value)
+        self._odd_types: t.List[t.Tuple[int, t.Any]] = []
+        self._odd_base_models: t.List[t.Tuple[int, t.Any]] = []
+        self._odd_tags: t.List[t.Tuple[int, t.Any]] = []
+
+        # stable permutations of positions per stats key, e.g. downloadCount, rating
+        self._sort_orders: t.Dict[str, t.List[int]] = {}
+
+        # first model per id, first version per (model id, version name)
+        self._model_by_id: t.Dict[t.Any, t.Dict] = {}
+        self._version_by_name: t.Dict[t.Tuple[t.Any, str], t.Dict] = {}
+        # first (model, version) per file name, per full SHA256 and per any upper-cased (short) hash
+        self._file_by_name: t.Dict[str, t.Tuple[t.Dict, t.Dict]] = {}
+        self._file_by_sha256: t.Dict[str, t.Tuple[t.Dict, t.Dict]] = {}
+        self._file_by_hash: t.Dict[str, t.Tuple[t.Dict, t.Dict]] = {}
+
+        self._build_lookups()
+        self._build_text_index()
+        self._build_facets()
+        self._build_sort_orders()
+
+    def __len__(self) -> int:
+        return len(self._models)
+
+    @property
+    def models(self) -> t.List[t.Dict]:
+        return self._models
+
+    def _build_lookups(self) -> None:
+        for model in self._models:
+            try:
+                mid = model['id']
+                if mid in self._model_by_id:
+                    continue
+                self._model_by_id[mid] = model
+
+                for version in model.get('modelVersions') or []:
+                    self._version_by_name.setdefault((mid, version.get('name')), version)
+            except Exception:
+                continue
+
+        for model in self._models:
+            try:
+                versions = model.get('modelVersions') or []
+            except Exception:
+                continue
+
+            for version in versions:
+                try:
+                    files = version.get('files') or []
+                except Exception:
+                    continue
+
+                for file in files:
+                    try:
+                        entry = (model, version)
+                        if isinstance(file.get('name'), str):
+                            self._file_by_name.setdefault(file['name'], entry)
+
+                        hashes = file.get('hashes') or {}
+                        sha256 = hashes.get('SHA256')
+                        if isinstance(sha256, str):
+                            self._file_by_sha256.setdefault(sha256.upper(), entry)
+                            # AutoV2 is the 10 leading chars of SHA256, even if the catalog misses it
+                            self._file_by_hash.setdefault(sha256[:10].upper(), entry)
+                        for h in hashes.values():
+                            if isinstance(h, str):
+                                self._file_by_hash.setdefault(h.upper(), entry)
+                    except Exception:
+                        continue
+
+    def get_model(self, mid: t.Any) -> t.Optional[t.Dict]:
+        try:
+            return self._model_by_id.get(mid)
+        except TypeError:
+            return None
+
+    def get_version(self, mid: t.Any, version_name: str) -> t.Optional[t.Dict]:
+        try:
+            return self._version_by_name.get((mid, version_name))
+        except TypeError:
+            return None
+
+    def find_file(self, filename: str = None, sha256: str = None,
+                  shorthash: str = None) -> t.Optional[t.Tuple[t.Dict, t.Dict]]:
+        """
+        identify a local model file, the file name wins over SHA256, SHA256 wins over the short hash
+        :return:
+            (model, version) of the first catalog file matched, None if nothing matched
+        """
+        if filename is not None and filename in self._file_by_name:
+            return self._file_by_name[filename]
+        if sha256 is not None and sha256.upper() in self._file_by_sha256:
+            return self._file_by_sha256[sha256.upper()]
+        if shorthash is not None:
+            return self._file_by_hash.get(shorthash[:10].upper())
+        return None
+
+    def _build_text_index(self) -> None:
+        for pos, model in enumerate(self._models):
+            fields = (None, None, None)
+            try:
+                filename = model['modelVersions'][0]['files'][0]['name'].lower()
+                name = model.get('name')
+                description = model.get('description')
+                if (name is not None and not isinstance(name, str)) \
+                        or (description is not None and not isinstance(description, str)):
+                    self._unsearchable.add(pos)
+                else:
+                    fields = (
+                        name.lower() if name is not None else None,
+                        description.lower() if description is not None else None,
+                        filename,
+                    )
+            except Exception:
+                self._unlisted.add(pos)
+
+            self._fields.append(fields)
+
+            tokens = set()
+            for field in fields:
+                if field:
+                    tokens.update(self._WORD.findall(field))
+            for token in tokens:
+                self._postings.setdefault(token, set()).add(pos)
+
+        self._tokens = sorted(self._postings.keys())
+        offset = 0
+        for token in self._tokens:
+            self._vocabulary_offsets.append(offset)
+            offset += len(token) + 1
+        # "\n" never belongs to a token, so a word pattern cannot match across two tokens
+        self._vocabulary = "\n".join(self._tokens)
+
+    @staticmethod
+    def _group(groups: t.Dict[t.Any, t.List[int]], odd: t.List[t.Tuple[int, t.Any]], value: t.Any, pos: int) -> None:
+        try:
+            groups.setdefault(value, []).append(pos)
+        except TypeError:
+            odd.append((pos, value))
+
+    @staticmethod
+    def _select(groups: t.Dict[t.Any, int], odd: t.List[t.Tuple[int, t.Any]],
+                predicate: t.Callable[[t.Any], bool]) -> int:
+        bits = 0
+        for value, group_bits in groups.items():
+            try:
+                if predicate(value):
+                    bits |= group_bits
+            except Exception:
+                continue
+
+        for pos, value in odd:
+            try:
+                if predicate(value):
+                    bits |= (1 << pos)
+            except Exception:
+                continue
+
+        return bits
+
+    @staticmethod
+    def _popcount(bits: int) -> int:
+        return bin(bits).count("1")
+
+    def _build_facets(self) -> None:
+        # collect positions first, one big int per facet value is created at the end
+        listed, safe, no_base_model = [], [], []
+        types, base_models, tags_group = {}, {}, {}
+
+        for pos, model in enumerate(self._models):
+            if pos in self._unlisted:
+                continue
+
+            listed.append(pos)
+            if not model.get('nsfw'):
+                safe.append(pos)
+
+            model_type = model.get('type')
+            if model_type is not None:
+                self._group(types, self._odd_types, model_type, pos)
+
+            latest_version = model['modelVersions'][0]
+            try:
+                if 'baseModel' not in latest_version.keys():
+                    no_base_model.append(pos)
+                else:
+                    self._group(base_models, self._odd_base_models, latest_version['baseModel'], pos)
+            except Exception:
+                pass
+
+            tags = model.get('tags')
+            if isinstance(tags, (list, tuple)):
+                for tag in set(tag for tag in tags if isinstance(tag, str)):
+                    tags_group.setdefault(tag, []).append(pos)
+            elif tags is not None:
+                self._odd_tags.append((pos, tags))
+
+        self._all_bits = self.to_bits(listed)
+        self._safe_bits = self.to_bits(safe)
+        self._no_base_model_bits = self.to_bits(no_base_model)
+        self._type_bits = {k: self.to_bits(v) for k, v in types.items()}
+        self._base_model_bits = {k: self.to_bits(v) for k, v in base_models.items()}
+        self._tag_bits = {k: self.to_bits(v) for k, v in tags_group.items()}
+
+    def _build_sort_orders(self) -> None:
+        stats_keys = set()
+        for model in self._models:
+            if isinstance(model.get('stats'), dict):
+                stats_keys.update(model['stats'].keys())
+
+        for key in stats_keys:
+            values = []
+            for model in self._models:
+                stats = model.get('stats')
+                value = stats.get(key) if isinstance(stats, dict) else None
+                values.append(value if isinstance(value, (int, float)) and not isinstance(value, bool) else None)
+
+            # highest value first, models without a value go last, equal values keep the catalog order
+            present = [pos for pos, value in enumerate(values) if value is not None]
+            present.sort(key=lambda pos: values[pos], reverse=True)
+            self._sort_orders[key] = present + [pos for pos, value in enumerate(values) if value is None]
+
+    def sort_order(self, sort_by: str = 'Default') -> t.Sequence[int]:
+        """
+        positions of models sorted by the given stats key, slice it for the top-k models
+        :param sort_by: key of model stats, 'Default' keeps the catalog order
+        :return:
+            permutation of model positions
+        """
+        if sort_by in self._sort_orders:
+            return self._sort_orders[sort_by]
+
+        # catalog order for 'Default', also for keys no model has
+        return range(len(self._models))
+
+    def to_bits(self, positions: t.Iterable[int]) -> int:
+        buffer = bytearray((len(self._models) + 7) // 8)
+        for pos in positions:
+            buffer[pos >> 3] |= 1 << (pos & 7)
+        return int.from_bytes(buffer, "little")
+
+    def to_positions(self, bits: int) -> t.Set[int]:
+        positions = set()
+        for idx, byte in enumerate(bits.to_bytes((len(self._models) + 7) // 8, "little")):
+            if byte:
+                for offset in range(8):
+                    if byte & (1 << offset):
+                        positions.add((idx << 3) + offset)
+        return positions
+
+    def type_bits(self, model_type: str = 'All') -> int:
+        if model_type == 'All':
+            return self._all_bits
+        return self._select(self._type_bits, self._odd_types, lambda value: model_type in value)
+
+    def nsfw_bits(self, allow_nsfw: bool = False) -> int:
+        return self._all_bits if allow_nsfw else self._safe_bits
+
+    def base_model_bits(self, base_model: t.List[str] = None) -> int:
+        if not base_model:
+            return self._no_base_model_bits
+        return self._no_base_model_bits | \
+            self._select(self._base_model_bits, self._odd_base_models, lambda value: value in base_model)
+
+    def tag_bits(self, model_tag: str = 'All') -> int:
+        if model_tag == 'All':
+            return self._all_bits
+
+        tag = model_tag.lower()
+        return self._tag_bits.get(tag, 0) | self._select({}, self._odd_tags, lambda value: tag in value)
+
+    def count(self, bits: int) -> int:
+        return self._popcount(bits & self._all_bits)
+
+    def count_base_models(self, bits: int, base_model_group: t.List[str]) -> t.Dict[str, int]:
+        return {bm: self._popcount(bits & self.base_model_bits([bm]) & ~self._no_base_model_bits)
+                for bm in base_model_group}
+
+    def count_tags(self, bits: int, model_tags: t.List[str]) -> t.Dict[str, int]:
+        return {tag: self._popcount(bits & self.tag_bits(tag)) for tag in model_tags}
+
+    def _positions_of_tokens_containing(self, pattern: str) -> t.Set[int]:
+        positions = set()
+        start = 0
+        while True:
+            found = self._vocabulary.find(pattern, start)
+            if found < 0:
+                break
+
+            idx = bisect.bisect_right(self._vocabulary_offsets, found) - 1
+            positions.update(self._postings[self._tokens[idx]])
+
+            # continue with the next token, the current one is consumed already
+            if idx + 1 >= len(self._tokens):
+                break
+            start = self._vocabulary_offsets[idx + 1]
+
+        return positions
+
+    def _match_fields(self, pos: int, pattern: str) -> bool:
+        for field in self._fields[pos]:
+            if field is not None and pattern in field:
+                return True
+        return False
+
+    def search(self, pattern: str = "") -> t.Set[int]:
+        """
+        find out models whose name, description or first file name contains the pattern
+        :param pattern: lower-cased search pattern, substring semantics
+        :return:
+            positions of matched models
+        """
+        if pattern == "":
+            return set(range(len(self._models))) - self._unlisted
+
+        words = self._WORD.findall(pattern)
+        if len(words) == 0:
+            candidates = set(range(len(self._models)))
+        else:
+            candidates = None
+            for word in sorted(set(words), key=len, reverse=True):
+                positions = self._positions_of_tokens_containing(word)
+                candidates = positions if candidates is None else candidates & positions
+                if not candidates:
+                    return set()
+
+        candidates -= self._unlisted
+        candidates -= self._unsearchable
+
+        # a pure word pattern only matches inside a single token, so the candidates are exact
+        if len(words) == 1 and words[0] == pattern:
+            return candidates
+
+        return {pos for pos in candidates if self._match_fields(pos, pattern)}
@@ -0,0 +1,188 @@
+import atexit
+import os
+import typing as t
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
+from threading import Lock
+
+from scripts.msai_logging.msai_logger import Logger
+from scripts.msai_utils import msai_toolkit as toolkit
+
+
+def calculate_sha256(file: str, buffer_size: int) -> str:
+    hasher = sha256()
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    with open(file, "rb") as f:
+        while True:
+            n = f.readinto(buffer)
+            if not n:
+                break
+            hasher.update(view[:n])
+    return hasher.hexdigest()
+
+
+class ModelHashEngine(object):
+    """
+    hash local models in background and persist sha256 keyed by (path, size, mtime),
+    callback(key, path, sha256) is invoked from a worker thread once a file is hashed
+    """
+    VERSION = 1
+    BUFFER_SIZE = 8 * 1024 * 1024
+    # hashing is disk bound, more readers only make spinning disks seek
+    MAX_WORKERS = 2
+    FLUSH_EVERY = 8
+
+    def __init__(self, store_file: str, callback: t.Callable[[str, str, str], None] = None,
+                 max_workers: int = MAX_WORKERS) -> None:
+        self.logger = Logger()
+        self._store_file = store_file
+        self._callback = callback
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="msai_hash")
+        self._mutex = Lock()
+        self._dataset: t.Optional[t.Dict[str, t.Any]] = None
+        self._unsaved = 0
+
+        # keyed by (path, size, mtime), a file still being written is submitted again once it changes
+        self._pending: t.Set[t.Tuple[str, int, int]] = set()
+        self._running: t.Set[t.Tuple[str, int, int]] = set()
+        self._finished = 0
+        self._failed = 0
+        self._bytes_total = 0
+        self._bytes_done = 0
+        # hashes put by others are written with the next batch of ours, or at exit
+        atexit.register(self.flush)
+
+    def _load_if_needed(self) -> None:
+        if self._dataset is not None:
+            return
+
+        dataset = None
+        if os.path.isfile(self._store_file):
+            dataset = toolkit.read_json(self._store_file)
+        if not isinstance(dataset, dict) or dataset.get("version") != ModelHashEngine.VERSION:
+            dataset = {"version": ModelHashEngine.VERSION, "entries": {}}
+        self._dataset = dataset
+
+    def get_sha256(self, path: str, size: int, mtime: int) -> t.Optional[str]:
+        with self._mutex:
+            self._load_if_needed()
+            entry = self._dataset["entries"].get(path)
+            if entry is None or entry["size"] != size or entry["mtime"] != mtime:
+                return None
+            return entry["sha256"]
+
+    def put_sha256(self, path: str, size: int, mtime: int, sha256_hash: str) -> None:
+        with self._mutex:
+            self._load_if_needed()
+            self._dataset["entries"][path] = {"size": size, "mtime": mtime, "sha256": sha256_hash.upper()}
+            self._unsaved += 1
+
+    def find_by_sha256(self, sha256_hash: str) -> t.Optional[str]:
+        """
+        :return:
+            path of a local file hashed to sha256_hash which is unchanged since, or None
+        """
+        sha256_hash = sha256_hash.upper()
+        with self._mutex:
+            self._load_if_needed()
+            candidates = [(path, entry["size"], entry["mtime"])
+                          for path, entry in self._dataset["entries"].items() if entry["sha256"] == sha256_hash]
+
+        for path, size, mtime in candidates:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if stat.st_size == size and stat.st_mtime_ns == mtime:
+                return path
+        return None
+
+    def submit(self, key: str, path: str, size: int, mtime: int) -> None:
+        with self._mutex:
+            if (path, size, mtime) in self._pending:
+                return
+            self._pending.add((path, size, mtime))
+            self._bytes_total += size
+
+        self._executor.submit(self._hash_file, key, path, size, mtime)
+
+    def _hash_file(self, key: str, path: str, size: int, mtime: int) -> None:
+        sha256_hash = None
+        changed = False
+        with self._mutex:
+            self._running.add((path, size, mtime))
+
+        try:
+            stat = os.stat(path)
+            if stat.st_size == size and stat.st_mtime_ns == mtime:
+                sha256_hash = calculate_sha256(path, ModelHashEngine.BUFFER_SIZE).upper()
+                # the file may be replaced while it is being read
+                stat = os.stat(path)
+            if stat.st_size != size or stat.st_mtime_ns != mtime:
+                # still being written, the job submitted for its later stat hashes it
+                sha256_hash = None
+                changed = True
+        except Exception as e:
+            self.logger.error(f"failed to hash {path}: {e}")
+
+        with self._mutex:
+            self._running.discard((path, size, mtime))
+            self._pending.discard((path, size, mtime))
+            if sha256_hash is None:
+                # nothing of it is done, it drops out of the progress
+                self._bytes_total -= size
+                self._failed += 0 if changed else 1
+
+        if sha256_hash is None:
+            return
+
+        self.logger.info(f"{path} is hashed: {sha256_hash}")
+        self.put_sha256(path, size, mtime, sha256_hash)
+        with self._mutex:
+            self._bytes_done += size
+            self._finished += 1
+            need_flush = self._unsaved >= ModelHashEngine.FLUSH_EVERY or len(self._pending) == 0
+        if need_flush:
+            self.flush()
+
+        if self._callback is not None:
+            try:
+                self._callback(key, path, sha256_hash)
+            except Exception as e:
+                self.logger.error(f"hash callback failed for {path}: {e}")
+
+    def flush(self) -> None:
+        with self._mutex:
+            if self._unsaved == 0 or self._dataset is None:
+                return
+            if toolkit.write_json_atomic(self._store_file, self._dataset, indent=None):
+                self._unsaved = 0
+            else:
+                self.logger.error(f"failed to save model hashes into {self._store_file}")
+
+    def progress(self) -> t.Tuple[int, int, int, float]:
+        """
+        :return:
+            (queued, finished, failed, finished percent of bytes) since startup
+        """
+        with self._mutex:
+            percent = self._bytes_done / self._bytes_total * 100 if self._bytes_total > 0 else 100.
+            return len(self._pending), self._finished, self._failed, percent
+
+    def summary(self) -> str:
+        queued, finished, failed, percent = self.progress()
+        if queued == 0 and finished == 0 and failed == 0:
+            return '<div><span>No models are being hashed</span></div>'
+
+        description = "<div>"
+        if queued > 0:
+            with self._mutex:
+                running = sorted(set(os.path.basename(p) for p, _, _ in self._running))
+            description += f'<p>Hashing: <span style="color:blue;font-weight:bold">{round(percent, 2)} %</span>'
+            if len(running) > 0:
+                description += f" ({', '.join(running)})"
+            description += "</p>"
+        description += f"<p>{finished} hashed, {queued} queued, {failed} failed</p>"
+        description += "</div>"
+        return description
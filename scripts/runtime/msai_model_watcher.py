@@ -0,0 +1,220 @@
+import ctypes
+import ctypes.util
+import os
+import platform
+import select
+import struct
+import typing as t
+from threading import Event, Lock, Thread
+
+from scripts.msai_logging.msai_logger import Logger
+
+
+class _Inotify(object):
+    # see <sys/inotify.h>
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+
+    WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE \
+        | IN_DELETE_SELF | IN_MOVE_SELF
+    EVENT_HEADER = struct.Struct("iIII")
+
+    def __init__(self, libc: t.Any, fd: int) -> None:
+        self._libc = libc
+        self.fd = fd
+
+    @classmethod
+    def create(cls) -> t.Optional["_Inotify"]:
+        if platform.system() != "Linux":
+            return None
+
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd < 0:
+                return None
+            return cls(libc, fd)
+        except Exception:
+            return None
+
+    def add_watch(self, directory: str) -> int:
+        return self._libc.inotify_add_watch(self.fd, os.fsencode(directory), _Inotify.WATCH_MASK)
+
+    def read_events(self, timeout: float) -> t.Optional[t.List[t.Tuple[int, int]]]:
+        """
+        wait for events
+        :return:
+            list of (wd, mask), None if timeout
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return None
+
+        events = []
+        try:
+            buffer = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return events
+
+        offset = 0
+        while offset + _Inotify.EVENT_HEADER.size <= len(buffer):
+            wd, mask, _, name_len = _Inotify.EVENT_HEADER.unpack_from(buffer, offset)
+            events.append((wd, mask))
+            offset += _Inotify.EVENT_HEADER.size + name_len
+        return events
+
+
+class ModelFolderWatcher(Thread):
+    """
+    watch model folders recursively, callback(key, event, path) is invoked from the watcher thread with
+    event in 'added', 'removed' and 'modified', a rename is reported as 'removed' followed by 'added'.
+    model folders may overlap, a file inside several of them is reported once for each of their keys.
+    inotify is used on Linux, stat polling anywhere else.
+    """
+    EXTENSIONS = ['.ckpt', '.safetensors', '.pt', '.jpg', '.png', '.webp']
+    POLL_INTERVAL = 10.
+    # inotify cannot watch folders which do not exist yet, sync everything from time to time
+    RESYNC_INTERVAL = 60.
+
+    def __init__(self, folders: t.Dict[str, str], callback: t.Callable[[str, str, str], None],
+                 poll_interval: float = POLL_INTERVAL) -> None:
+        super(ModelFolderWatcher, self).__init__(daemon=True)
+        self.logger = Logger()
+        self._folders = folders
+        self._callback = callback
+        self._poll_interval = poll_interval
+        self._stopped = Event()
+        self._mutex = Lock()
+
+        self._inotify: t.Optional[_Inotify] = None
+        self._watches: t.Dict[int, str] = {}
+        # file path -> (size, mtime)
+        self._files: t.Dict[str, t.Tuple[int, int]] = {}
+        # directory -> file paths in it, every directory scanned so far
+        self._directories: t.Dict[str, t.Set[str]] = {}
+
+    @property
+    def backend(self) -> str:
+        return "inotify" if self._inotify is not None else "polling"
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+    def run(self) -> None:
+        self._inotify = _Inotify.create()
+        self.logger.info(f"model folder watcher is running with {self.backend}")
+
+        # a directory is watched before it is scanned, the kernel queues whatever changes during the initial
+        # scan and the events are replayed against the snapshots right after it
+        with self._mutex:
+            self._sync_all(emit=False)
+
+        while not self._stopped.is_set():
+            try:
+                if self._inotify is None:
+                    self._stopped.wait(self._poll_interval)
+                    with self._mutex:
+                        self._sync_all(emit=True)
+                else:
+                    self._wait_inotify_events()
+            except Exception as e:
+                self.logger.error(f"model folder watcher error: {e}")
+                self._stopped.wait(self._poll_interval)
+
+    def _wait_inotify_events(self) -> None:
+        events = self._inotify.read_events(ModelFolderWatcher.RESYNC_INTERVAL)
+
+        with self._mutex:
+            if events is None or any(mask & _Inotify.IN_Q_OVERFLOW for _, mask in events):
+                self._sync_all(emit=True)
+                return
+
+            for directory in set(self._watches.get(wd) for wd, _ in events):
+                if directory is None or directory not in self._directories:
+                    continue
+                if os.path.isdir(directory):
+                    self._scan_directory(directory, emit=True)
+                else:
+                    self._forget_tree(directory, emit=True)
+
+            for wd, mask in events:
+                if mask & _Inotify.IN_IGNORED:
+                    self._watches.pop(wd, None)
+
+    def _keys_of(self, path: str) -> t.List[str]:
+        return [key for key, folder in self._folders.items() if path.startswith(os.path.join(folder, ""))]
+
+    def _emit(self, event: str, path: str) -> None:
+        for key in self._keys_of(path):
+            try:
+                self._callback(key, event, path)
+            except Exception as e:
+                self.logger.error(f"model folder watcher callback failed for {event} {path}: {e}")
+
+    def _sync_all(self, emit: bool) -> None:
+        seen = set()
+        for folder in self._folders.values():
+            for root, dirs, files in os.walk(folder):
+                # a folder inside another one is walked twice, but scanned once
+                if root not in seen:
+                    seen.add(root)
+                    self._scan_directory(root, emit, recursive=False)
+
+        for directory in [d for d in self._directories.keys() if d not in seen]:
+            self._forget_tree(directory, emit)
+
+    def _scan_directory(self, directory: str, emit: bool, recursive: bool = True) -> None:
+        if directory not in self._directories and self._inotify is not None:
+            wd = self._inotify.add_watch(directory)
+            if wd >= 0:
+                self._watches[wd] = directory
+
+        current = {}
+        subdirs = []
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=True):
+                        subdirs.append(entry.path)
+                    elif os.path.splitext(entry.name)[1].lower() in ModelFolderWatcher.EXTENSIONS:
+                        stat = entry.stat()
+                        current[entry.path] = (stat.st_size, stat.st_mtime_ns)
+        except OSError:
+            self._forget_tree(directory, emit)
+            return
+
+        previous = {path: self._files.pop(path) for path in self._directories.get(directory, set())}
+        self._files.update(current)
+        self._directories[directory] = set(current.keys())
+
+        if emit:
+            for path in previous.keys() - current.keys():
+                self._emit("removed", path)
+            for path, signature in current.items():
+                if path not in previous:
+                    self._emit("added", path)
+                elif previous[path] != signature:
+                    self._emit("modified", path)
+
+        if recursive:
+            for d in [d for d in self._directories.keys() if os.path.dirname(d) == directory and d not in subdirs]:
+                self._forget_tree(d, emit)
+            for subdir in subdirs:
+                if subdir not in self._directories:
+                    self._scan_directory(subdir, emit)
+
+    def _forget_tree(self, directory: str, emit: bool) -> None:
+        prefix = os.path.join(directory, "")
+        for d in [d for d in self._directories.keys() if d == directory or d.startswith(prefix)]:
+            for path in self._directories.pop(d):
+                self._files.pop(path, None)
+                if emit:
+                    self._emit("removed", path)
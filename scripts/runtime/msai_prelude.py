@@ -1,3 +1,5 @@
+import atexit
+import copy
 import launch
 import modules
 import os
@@ -10,6 +12,7 @@ from modules import shared
 
 from scripts.msai_logging.msai_logger import Logger
 from scripts.msai_utils import msai_toolkit as toolkit
+from scripts.msai_utils.msai_json_file import ResidentJsonFile
 from scripts.msai_utils.msai_singleton import MiaoshouSingleton
 
 
@@ -39,6 +42,8 @@ class MiaoshouPrelude(metaclass=MiaoshouSingleton):
         }
         self._ext_folder = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
         self._setting_file = os.path.join(self.ext_folder, "configs", "settings.json")
+        self._settings = ResidentJsonFile(self._setting_file, default=lambda: None)
+        atexit.register(self._settings.flush)
         self._model_hash_file = os.path.join(self.ext_folder, "configs", "model_hash.json")
         self._gpt_index = os.path.join(self.ext_folder, "configs", "gpt_index.json")
         self._assets_folder = os.path.join(self.ext_folder, "assets")
@@ -98,15 +103,40 @@ class MiaoshouPrelude(metaclass=MiaoshouSingleton):
 
     @property
     def all_settings(self) -> t.Any:
-        return toolkit.read_json(self._setting_file)
+        """
+        a copy of the settings, they are cached and only read again when settings.json is changed on disk,
+        changes go through update_boot_settings()
+        """
+        with self._settings.mutex:
+            return copy.deepcopy(self._settings.load())
 
     @property
     def boot_settings(self) -> t.Any:
-        all_setting = self.all_settings
-        if all_setting:
-            return all_setting['boot_settings']
-        else:
-            return None
+        """
+        a copy, see all_settings
+        """
+        with self._settings.mutex:
+            all_setting = self._settings.load()
+            if all_setting:
+                return copy.deepcopy(all_setting['boot_settings'])
+            else:
+                return None
+
+    def update_boot_settings(self, settings: t.Dict[str, t.Any], flush: bool = False) -> None:
+        """
+        merge settings into boot_settings, the file is written once changes settle down
+        :param flush: write it out right now
+        """
+        with self._settings.mutex:
+            all_settings = self._settings.load()
+            if all_settings is None:
+                self._logger.error(f"cannot update settings, {self._setting_file} is not loaded")
+                return
+            all_settings.setdefault('boot_settings', {}).update(settings)
+            self._settings.mark_dirty()
+
+        if flush:
+            self._settings.flush()
 
     def api_url(self, model_source: str) -> t.Optional[str]:
         return self._api_url.get(model_source)
@@ -1,3 +1,4 @@
+import concurrent.futures
 import datetime
 import fileinput
 import gc
@@ -15,7 +16,6 @@ import os
 import platform
 import random
 import re
-import requests
 import shutil
 import subprocess
 import sys
@@ -28,22 +28,41 @@ from gpt_index import SimpleDirectoryReader, GPTListIndex, GPTSimpleVectorIndex,
 from modules import shared, sd_hijack, sd_samplers, processing, images
 from modules.sd_models import CheckpointInfo
 from numba import cuda
+from threading import Lock
 
 from scripts.download.msai_downloader_manager import MiaoshouDownloaderManager
+from scripts.download.msai_progress_view import DownloadProgressView
 from scripts.msai_logging.msai_logger import Logger
+from scripts.msai_utils.msai_http import MiaoshouHttpClient
 from scripts.msai_utils import msai_toolkit as toolkit
+from scripts.msai_utils.msai_json_file import ResidentJsonFile
+from scripts.runtime.msai_api_cache import ModelApiCache
+from scripts.runtime.msai_catalog_index import ModelCatalogIndex
+from scripts.runtime.msai_hash_engine import ModelHashEngine
+from scripts.runtime.msai_model_watcher import ModelFolderWatcher
 from scripts.runtime.msai_prelude import MiaoshouPrelude
+from scripts.runtime.msai_scan_cache import LocalModelScanCache
 
 
 class MiaoshouRuntime(object):
+    # seconds to wait for the downloader manager to apply a pause, resume or cancel
+    CONTROL_TIMEOUT = 5.
+    # "<name> (<count>)", the label of a base model or tag choice
+    FACET_COUNT_PATTERN = re.compile(r" \(\d+\)$")
+
     def __init__(self):
         self.cmdline_args: t.List[str] = None
         self.logger = Logger()
         self.prelude = MiaoshouPrelude()
         self._old_additional: str = None
         self._model_set: t.List[t.Dict] = None
-        self._sorted_model_set: t.List[t.Dict] = None
+        self._model_index: ModelCatalogIndex = None
+        self._facet_counts: t.Dict[str, t.Dict[str, int]] = {}
+        # base models and tag of the last search
+        self._facet_selection: t.Tuple[t.List[str], str] = ([], 'All')
+        self._sort_by: str = 'Default'
         self._my_model_set: t.List[t.Dict] = None
+        self._my_model_index: ModelCatalogIndex = None
         self._active_model_set: str = None
         self._model_set_last_access_time: datetime.datetime = None
         self._my_model_set_last_access_time: datetime.datetime = None
@@ -59,7 +78,43 @@ class MiaoshouRuntime(object):
         # TODO: may be owned by downloader class
         self.model_files = []
 
-        self.downloader_manager = MiaoshouDownloaderManager()
+        boot_settings = self.prelude.boot_settings or {}
+        self.downloader_manager = MiaoshouDownloaderManager(
+            max_concurrent_transfers=int(boot_settings.get('max_concurrent_downloads', 4)),
+            max_bytes_per_second=float(boot_settings.get('download_bandwidth_limit_mb', 0)) * 1024 * 1024,
+            local_file_resolver=self.find_local_model_by_sha256,
+            staging_dir=boot_settings.get('download_staging_dir', ''),
+            queue_file=os.path.join(self.prelude.cache_folder, "download_queue.json"),
+            on_verified=self.on_model_verified,
+        )
+        self.downloader_manager.collect_orphaned_partials(
+            list(self.prelude.model_type.values()),
+            float(boot_settings.get('download_partial_budget_mb', 10240)) * 1024 * 1024,
+        )
+        self.model_hashes = ResidentJsonFile(self.prelude.model_hash_file)
+        # a model page asks for the same id several times, e.g. on every version change
+        self.model_api_cache = ModelApiCache(
+            os.path.join(self.prelude.cache_folder, "model_api.json")
+            if boot_settings.get('enable_model_api_disk_cache', True) else None,
+            ttl=float(boot_settings.get('model_api_cache_ttl_minutes', 30)) * 60,
+        )
+        self.scan_cache = LocalModelScanCache(os.path.join(self.prelude.cache_folder, "local_models.json"))
+
+        # model type -> {model path: row}, kept up to date by the model folder watcher once fully scanned
+        self._local_models: t.Dict[str, t.Dict[str, t.List[t.Any]]] = {}
+        self._local_models_signature: t.Tuple[str, float] = None
+        self._local_models_mutex = Lock()
+        # model type -> watcher events which arrive while its table is being scanned, replayed onto the table
+        self._local_models_pending_events: t.Dict[str, t.List[t.Tuple[str, str]]] = {}
+        self.model_watcher: ModelFolderWatcher = None
+        if (self.prelude.boot_settings or {}).get('enable_model_watcher', True):
+            self.model_watcher = ModelFolderWatcher(self.prelude.model_type, self.on_model_folder_changed)
+            self.model_watcher.start()
+
+        self.hash_engine: ModelHashEngine = None
+        if (self.prelude.boot_settings or {}).get('enable_model_hashing', True):
+            self.hash_engine = ModelHashEngine(os.path.join(self.prelude.cache_folder, "model_sha256.json"),
+                                               self.on_model_hashed)
 
 
     def get_default_args(self, commandline_args: t.List[str] = None):
@@ -181,88 +236,101 @@ class MiaoshouRuntime(object):
             self.logger.error(f"ds models is null")
 
     def sort_dataset(self, search='', chk_nsfw=False, base_model=None, model_type='All', model_tag='All',
-                     sort_by='Default') -> t.Dict:
-
-        def sort_key(item, key):
-            if key in item['stats']:
-                return item['stats'][key]
-
-        if sort_by != 'Default':
-            self.sorted_model_set = sorted(self.model_set, key=lambda item: sort_key(item, sort_by), reverse=True)
-        else:
-            self.sorted_model_set = self.model_set
-
-        if self.ds_models:
-            self.ds_models.samples = self.sorted_model_set
-            self.ds_models.update(samples=self.sorted_model_set)
-        else:
-            self.logger.error(f"ds models is null")
+                     sort_by='Default') -> t.Tuple[t.Dict, t.Dict, t.Dict]:
+        self.sort_by = sort_by
 
         new_list = self.get_images_html(search, chk_nsfw, base_model, model_type, model_tag)
 
         self._ds_models.samples = new_list
-        return self._ds_models.update(samples=new_list)
+        return (self._ds_models.update(samples=new_list), *self.get_facet_updates())
 
     def get_images_html(self, search: str = '', chk_nsfw: bool = False, base_model=None, model_type: str = 'All', model_tag: str = 'All') -> t.List[str]:
         if base_model is None:
             base_model = []
+        # the choices are labelled with their counts
+        base_model = [MiaoshouRuntime.facet_name(label) for label in base_model]
+        model_tag = MiaoshouRuntime.facet_name(model_tag or 'All')
+        self._facet_selection = (base_model, model_tag)
         self.logger.info(f"get_image_html: model_type = {model_type}, and search pattern = '{search}'")
 
         model_cover_thumbnails = []
-        model_format = []
-
-        if self.sorted_model_set is None:
-            if self.model_set is None:
-                self.logger.error("model_set is null")
-                return []
-            else:
-                self.sorted_model_set = self.model_set
 
+        if self.model_set is None:
+            self.logger.error("model_set is null")
+            return []
 
         self.logger.info(f"{len(self.model_set)} items inside '{self.model_source}'")
 
-        search = search.lower()
-        for model in self.sorted_model_set:
+        self._allow_nsfw = chk_nsfw
+        model_index = self.model_index
+        search_bits = model_index.to_bits(model_index.search(search.lower()))
+        type_bits = model_index.type_bits(model_type)
+        nsfw_bits = model_index.nsfw_bits(self.allow_nsfw)
+        base_model_bits = model_index.base_model_bits(base_model)
+        tag_bits = model_index.tag_bits(model_tag)
+
+        common_bits = search_bits & type_bits & nsfw_bits
+        self._facet_counts = {
+            "base_model": model_index.count_base_models(common_bits & tag_bits, self.prelude.base_model_group),
+            "tags": {'All': model_index.count(common_bits & base_model_bits),
+                     **model_index.count_tags(common_bits & base_model_bits, self.prelude.model_tags)},
+        }
+
+        matched = model_index.to_positions(common_bits & base_model_bits & tag_bits)
+        for pos in model_index.sort_order(self.sort_by):
             try:
-                if model.get('type') is not None \
-                        and model.get('type') not in model_format:
-                    model_format.append(model['type'])
-
-                in_filename = search in model['modelVersions'][0]['files'][0]['name'].lower()
-
-                if search == '' or \
-                        (model.get('name') is not None and search.lower() in model.get('name').lower()) \
-                        or (model.get('description') is not None and search.lower() in model.get('description').lower()) \
-                        or in_filename:
-
-                    self._allow_nsfw = chk_nsfw
-                    if (model_type == 'All' or model_type in model.get('type')) \
-                            and (self.allow_nsfw or (not self.allow_nsfw and not model.get('nsfw'))) \
-                            and ('baseModel' not in model['modelVersions'][0].keys() or (len(base_model) > 0 and model['modelVersions'][0]['baseModel'] in base_model)) \
-                            and (model_tag == 'All' or model_tag.lower() in model.get('tags')):
-
-                        model_cover_thumbnails.append([
-                            [f"""
-                                <div style="display: flex; align-items: center;">
-                                    <div id="{str(model.get('id'))}" style="margin-right: 10px;" class="model-item">
-                                        <img referrerpolicy="no-referrer" src="{model['modelVersions'][0]['images'][0]['url'].replace('width=450', 'width=100')}" style="width:100px;">
-                                    </div>
-                                    <div style="flex:1; width:100px;">
-                                        <h3 style="text-align:left; word-wrap:break-word;">{model.get('name')}</h3>
-                                        <p  style="text-align:left;">Type: {model.get('type')}</p>
-                                        <p  style="text-align:left;">Rating: {model.get('stats')['rating']}</p>
-                                    </div>
+                if pos in matched:
+                    model = model_index.models[pos]
+                    model_cover_thumbnails.append([
+                        [f"""
+                            <div style="display: flex; align-items: center;">
+                                <div id="{str(model.get('id'))}" style="margin-right: 10px;" class="model-item">
+                                    <img referrerpolicy="no-referrer" src="{model['modelVersions'][0]['images'][0]['url'].replace('width=450', 'width=100')}" style="width:100px;">
                                 </div>
-                             """],
-                            model['id']])
+                                <div style="flex:1; width:100px;">
+                                    <h3 style="text-align:left; word-wrap:break-word;">{model.get('name')}</h3>
+                                    <p  style="text-align:left;">Type: {model.get('type')}</p>
+                                    <p  style="text-align:left;">Rating: {model.get('stats')['rating']}</p>
+                                </div>
+                            </div>
+                         """],
+                        model['id']])
             except Exception:
                 continue
 
         return model_cover_thumbnails
 
+    @staticmethod
+    def facet_name(label: str) -> str:
+        return MiaoshouRuntime.FACET_COUNT_PATTERN.sub("", label)
+
+    def _facet_label(self, facet: str, name: str) -> str:
+        counts = self._facet_counts.get(facet, {})
+        return f"{name} ({counts[name]})" if name in counts else name
+
+    def base_model_choices(self, names: t.List[str] = None) -> t.List[str]:
+        """
+        :return:
+            labels of the base models with their counts in the last search, every base model if names is None
+        """
+        names = self.prelude.base_model_group if names is None else names
+        return [self._facet_label("base_model", name) for name in names]
+
+    def model_tag_choices(self) -> t.List[str]:
+        return [self._facet_label("tags", name) for name in ['All'] + self.prelude.model_tags]
+
+    def get_facet_updates(self) -> t.Tuple[t.Dict, t.Dict]:
+        """
+        :return:
+            updates of the base model and tag choices, relabelled with the counts of the last search
+        """
+        base_model, model_tag = self._facet_selection
+        return (gr.CheckboxGroup.update(choices=self.base_model_choices(), value=self.base_model_choices(base_model)),
+                gr.Radio.update(choices=self.model_tag_choices(), value=self._facet_label("tags", model_tag)))
+
     # TODO: add typing hint
     def update_boot_settings(self, version, drp_gpu, drp_theme, txt_listen_port, chk_group_args, additional_args):
-        boot_settings = self.prelude.boot_settings
+        boot_settings = {}
         boot_settings['drp_args_vram'] = drp_gpu
         boot_settings["drp_args_theme"] = drp_theme
         boot_settings['txt_args_listen_port'] = txt_listen_port
@@ -272,18 +340,11 @@ class MiaoshouRuntime(object):
         boot_settings['txt_args_more'] = additional_args
         boot_settings['drp_choose_version'] = version
 
-        all_settings = self.prelude.all_settings
-        all_settings['boot_settings'] = boot_settings
-
-        toolkit.write_json(self.prelude.setting_file, all_settings)
+        # webui may be restarted right after, do not wait for the debounce
+        self.prelude.update_boot_settings(boot_settings, flush=True)
 
     def update_boot_setting(self, setting, value):
-        boot_settings = self.prelude.boot_settings
-        boot_settings[setting] = value
-
-        all_settings = self.prelude.all_settings
-        all_settings['boot_settings'] = boot_settings
-        toolkit.write_json(self.prelude.setting_file, all_settings)
+        self.prelude.update_boot_settings({setting: value})
 
     def change_auto_vram(self, auto_vram):
         self.update_boot_setting('auto_vram', auto_vram)
@@ -325,14 +386,15 @@ class MiaoshouRuntime(object):
         toolkit.write_json(self.prelude.model_json[site], models)
 
     def get_hash_from_json(self, chk_point: CheckpointInfo) -> CheckpointInfo:
-        model_hashes = toolkit.read_json(self.prelude.model_hash_file)
+        with self.model_hashes.mutex:
+            model_hashes = self.model_hashes.load()
 
-        if len(model_hashes) == 0 or chk_point.title not in model_hashes.keys():
-            chk_point.shorthash = self.calculate_shorthash(chk_point)
-            model_hashes[chk_point.title] = chk_point.shorthash
-            toolkit.write_json(self.prelude.model_hash_file, model_hashes)
-        else:
-            chk_point.shorthash = model_hashes[chk_point.title]
+            if len(model_hashes) == 0 or chk_point.title not in model_hashes.keys():
+                chk_point.shorthash = self.calculate_shorthash(chk_point)
+                model_hashes[chk_point.title] = chk_point.shorthash
+                self.model_hashes.mark_dirty()
+            else:
+                chk_point.shorthash = model_hashes[chk_point.title]
 
         return chk_point
 
@@ -342,6 +404,60 @@ class MiaoshouRuntime(object):
         else:
             return chk_point.sha256[0:10]
 
+    def get_hash_from_engine(self, chk_point: CheckpointInfo, mpath: str, model_type: str) -> CheckpointInfo:
+        if self.hash_engine is None:
+            return chk_point
+
+        try:
+            stat = os.stat(mpath)
+        except OSError:
+            return chk_point
+
+        sha256 = self.hash_engine.get_sha256(mpath, stat.st_size, stat.st_mtime_ns)
+        if sha256 is None:
+            # not hashed by webui nor by us yet, the row gets resolved again once the hash is ready
+            self.hash_engine.submit(model_type, mpath, stat.st_size, stat.st_mtime_ns)
+        else:
+            chk_point.sha256 = sha256
+            chk_point.shorthash = self.calculate_shorthash(chk_point)
+        return chk_point
+
+    def put_hash_into_engine(self, mpath: str, sha256: str) -> None:
+        if self.hash_engine is None:
+            return
+
+        try:
+            stat = os.stat(mpath)
+        except OSError:
+            return
+
+        if self.hash_engine.get_sha256(mpath, stat.st_size, stat.st_mtime_ns) != sha256.upper():
+            self.hash_engine.put_sha256(mpath, stat.st_size, stat.st_mtime_ns, sha256)
+
+    def on_model_hashed(self, model_type: str, mpath: str, sha256: str) -> None:
+        self.update_local_model_row(mpath, model_type, use_cache=False)
+
+    def on_model_verified(self, mpath: str, staged_file: str, sha256: str) -> None:
+        # called before the staged file is renamed to mpath, which keeps its size and mtime,
+        # so the folder watcher finds the hash ready instead of queueing the model for hashing
+        if self.hash_engine is None or not self.is_local_model_file(os.path.basename(mpath)):
+            return
+
+        stat = os.stat(staged_file)
+        self.hash_engine.put_sha256(mpath, stat.st_size, stat.st_mtime_ns, sha256)
+        self.hash_engine.flush()
+        self.logger.info(f"{mpath} is registered with sha256 {sha256}")
+
+    def find_local_model_by_sha256(self, sha256: str) -> t.Optional[str]:
+        if self.hash_engine is None:
+            return None
+        return self.hash_engine.find_by_sha256(sha256)
+
+    def get_hashing_status(self):
+        if self.hash_engine is None:
+            return gr.HTML.update(value='<div><span>Background hashing is disabled</span></div>')
+        return gr.HTML.update(value=self.hash_engine.summary())
+
 
     def update_my_model_type(self, search_txt, model_type) -> t.Dict:
         my_models = self.get_local_models(search_txt, model_type)
@@ -349,41 +465,200 @@ class MiaoshouRuntime(object):
 
         return gr.Dataset.update(samples=my_models)
 
-    def get_local_models(self, search_txt='', model_type='Checkpoint') -> t.List[t.Any]:
-        models = []
+    def get_local_models(self, search_txt='', model_type='Checkpoint', use_cache: bool = True) -> t.List[t.Any]:
+        if use_cache and self.is_local_model_table_ready(model_type):
+            with self._local_models_mutex:
+                table = list(self._local_models[model_type].items())
+            return [row for mpath, row in table
+                    if search_txt == '' or search_txt in os.path.splitext(os.path.basename(mpath))[0]]
 
-        for root, dirs, files in os.walk(self.prelude.model_type[model_type]):
-            for file in files:
-                mpath = os.path.join(root, file)
+        rows = {}
+        model_folder = self.prelude.model_type[model_type]
+        full_scan = search_txt == '' and self.model_watcher is not None
+        if full_scan:
+            with self._local_models_mutex:
+                self._local_models_pending_events.setdefault(model_type, [])
 
-                fname, ext = os.path.splitext(file)
-                if ext in ['.ckpt', '.safetensors', '.pt'] and file != 'scaler.pt' and (search_txt in fname or search_txt == ''):
-                    chkpt_info = modules.sd_models.get_closet_checkpoint_match(file)
-                    if chkpt_info is None:
-                        chkpt_info = CheckpointInfo(os.path.join(root, file))
+        try:
+            for root, dirs, files in os.walk(model_folder):
+                listed_files = set([os.path.normcase(f) for f in files])
+                for file in files:
+                    fname, ext = os.path.splitext(file)
+                    if self.is_local_model_file(file) and (search_txt in fname or search_txt == ''):
+                        mpath = os.path.join(root, file)
+                        row = self.get_local_model_row(mpath, model_type, listed_files, use_cache)
+                        if row is not None:
+                            rows[mpath] = row
+        except Exception:
+            if full_scan:
+                with self._local_models_mutex:
+                    self._local_models_pending_events.pop(model_type, None)
+            raise
+
+        if search_txt == '':
+            self.scan_cache.prune(self.my_model_source, model_folder, rows.keys())
+        if full_scan:
+            with self._local_models_mutex:
+                self._local_models[model_type] = rows
+                pending_events = self._local_models_pending_events.pop(model_type, [])
+            # files which changed after they were listed
+            for event, path in pending_events:
+                self.on_model_folder_changed(model_type, event, path)
+            with self._local_models_mutex:
+                rows = dict(self._local_models[model_type])
+        self.scan_cache.flush()
+        self.model_hashes.flush()
+
+        return list(rows.values())
+
+    def is_local_model_file(self, file: str) -> bool:
+        fname, ext = os.path.splitext(file)
+        return ext in ['.ckpt', '.safetensors', '.pt'] and file != 'scaler.pt'
+
+    def get_my_model_catalog_mtime(self) -> float:
+        try:
+            return toolkit.get_file_last_modified_time(self.prelude.model_json[self.my_model_source]).timestamp()
+        except Exception:
+            return 0.
+
+    def is_local_model_table_ready(self, model_type: str) -> bool:
+        if self.model_watcher is None or not self.model_watcher.is_alive():
+            return False
+
+        signature = (self.my_model_source, self.get_my_model_catalog_mtime())
+        with self._local_models_mutex:
+            if self._local_models_signature != signature:
+                # rows are resolved against another catalog
+                self._local_models.clear()
+                self._local_models_signature = signature
+            return model_type in self._local_models
+
+    def get_local_model_row(self, mpath: str, model_type: str, listed_files: t.Set[str] = None,
+                            use_cache: bool = True) -> t.Optional[t.List[t.Any]]:
+        try:
+            stat = os.stat(mpath)
+        except OSError:
+            return None
 
-                    if chkpt_info.sha256 is None and chkpt_info.shorthash is None:
-                        chkpt_info = self.get_hash_from_json(chkpt_info)
+        model_source = self.my_model_source
+        catalog_mtime = self.get_my_model_catalog_mtime()
+        root, file = os.path.split(mpath)
+        cover_signature = self.get_cover_signature(root, os.path.splitext(file)[0], listed_files)
+
+        row = None
+        if use_cache:
+            row = self.scan_cache.lookup(model_source, catalog_mtime, mpath, stat.st_size, stat.st_mtime_ns,
+                                         cover_signature)
+        if row is None:
+            row = self.resolve_local_model(root, file, model_type)
+            self.scan_cache.store(model_source, catalog_mtime, mpath, stat.st_size, stat.st_mtime_ns,
+                                  cover_signature, row)
+        return row
+
+    def update_local_model_row(self, mpath: str, model_type: str,
+                               use_cache: bool = True) -> t.Optional[t.List[t.Any]]:
+        row = self.get_local_model_row(mpath, model_type, use_cache=use_cache)
+        self.scan_cache.flush()
+
+        with self._local_models_mutex:
+            if model_type in self._local_models:
+                if row is None:
+                    self._local_models[model_type].pop(mpath, None)
+                else:
+                    self._local_models[model_type][mpath] = row
+        return row
+
+    def remove_local_model_row(self, mpath: str, model_type: str) -> None:
+        self.scan_cache.invalidate(mpath)
+        self.scan_cache.flush()
+
+        with self._local_models_mutex:
+            if model_type in self._local_models:
+                self._local_models[model_type].pop(mpath, None)
+
+    def on_model_folder_changed(self, model_type: str, event: str, path: str) -> None:
+        with self._local_models_mutex:
+            if model_type in self._local_models_pending_events:
+                self._local_models_pending_events[model_type].append((event, path))
+                return
+            if model_type not in self._local_models:
+                return
+            table_paths = list(self._local_models[model_type].keys())
+
+        if self.is_local_model_file(os.path.basename(path)):
+            self.logger.info(f"model folder watcher: {event} {path}")
+            if event == "removed":
+                self.remove_local_model_row(path, model_type)
+            else:
+                self.update_local_model_row(path, model_type)
+        else:
+            # a cover image changes, refresh the rows of models sharing its name
+            prefix = os.path.splitext(path)[0]
+            for mpath in table_paths:
+                if os.path.splitext(mpath)[0] == prefix:
+                    self.update_local_model_row(mpath, model_type)
+
+    def replace_local_model_rows(self, updated_rows: t.Dict[str, t.Optional[t.List[t.Any]]]) -> t.List[t.Any]:
+        """
+        apply single-row deltas onto the listed models
+        :param updated_rows: {file name shown in the list: new row, None to remove the row}
+        """
+        my_models = []
+        for model in self.ds_my_models.samples:
+            fname = model[3][0] if len(model) > 3 and len(model[3]) > 0 else None
+            if fname in updated_rows:
+                if updated_rows[fname] is not None:
+                    my_models.append(updated_rows[fname])
+            else:
+                my_models.append(model)
+        return my_models
+
+    def get_cover_signature(self, root: str, fname: str, listed_files: t.Set[str] = None) -> t.List[t.Any]:
+        # the same lookup order as search_model_info uses to pick up a cover
+        for ext in ['.jpg', '.png', '.webp']:
+            if listed_files is None and os.path.exists(os.path.join(root, f'{fname}{ext}')) \
+                    or listed_files is not None and os.path.normcase(f'{fname}{ext}') in listed_files:
+                try:
+                    stat = os.stat(os.path.join(root, f'{fname}{ext}'))
+                    return [ext, stat.st_size, stat.st_mtime_ns]
+                except OSError:
+                    break
+        return []
 
-                    model_info = self.search_model_info(chkpt_info, mpath, model_type)
-                    fname = re.sub(r'\[.*?\]', "", chkpt_info.title)
+    def resolve_local_model(self, root: str, file: str, model_type: str) -> t.List[t.Any]:
+        mpath = os.path.join(root, file)
 
-                    if model_info is not None:
-                        models.append(model_info)
-                    else:
-                        self.logger.info(
-                            f"{chkpt_info.title}, {chkpt_info.hash}, {chkpt_info.shorthash}, {chkpt_info.sha256}")
-                        models.append([
-                            self.prelude.no_preview_img,
-                            0,
-                            [os.path.basename(fname)],
-                            [mpath.replace(self.prelude.model_type[model_type]+'\\', '')]])
+        chkpt_info = modules.sd_models.get_closet_checkpoint_match(file)
+        if chkpt_info is None:
+            chkpt_info = CheckpointInfo(os.path.join(root, file))
 
-        return models
+        if chkpt_info.sha256 is None:
+            chkpt_info = self.get_hash_from_engine(chkpt_info, mpath, model_type)
+        elif os.path.abspath(chkpt_info.filename) == os.path.abspath(mpath):
+            # hashed by webui, the engine has to know it as well for downloads to be satisfied by this file
+            self.put_hash_into_engine(mpath, chkpt_info.sha256)
+
+        if chkpt_info.sha256 is None and chkpt_info.shorthash is None:
+            chkpt_info = self.get_hash_from_json(chkpt_info)
+
+        model_info = self.search_model_info(chkpt_info, mpath, model_type)
+        fname = re.sub(r'\[.*?\]', "", chkpt_info.title)
+
+        if model_info is not None:
+            return model_info
+
+        self.logger.info(
+            f"{chkpt_info.title}, {chkpt_info.hash}, {chkpt_info.shorthash}, {chkpt_info.sha256}")
+        return [
+            self.prelude.no_preview_img,
+            0,
+            [os.path.basename(fname)],
+            [mpath.replace(self.prelude.model_type[model_type]+'\\', '')]]
 
 
     def refresh_local_models(self, search_txt, model_type) -> t.Dict:
-        my_models = self.get_local_models(search_txt, model_type)
+        # explicit refresh resolves every file again, in case webui learned new hashes meanwhile
+        my_models = self.get_local_models(search_txt, model_type, use_cache=False)
         self.ds_my_models.samples = my_models
 
         return gr.Dataset.update(samples=my_models)
@@ -394,12 +669,14 @@ class MiaoshouRuntime(object):
         mpapth = os.path.join(mfolder, fname)
 
         os.remove(mpapth)
-        my_models = self.get_local_models(search_txt, model_type)
+        self.remove_local_model_row(mpapth, model_type)
+        my_models = self.replace_local_model_rows({fname: None})
         self.ds_my_models.samples = my_models
 
         return gr.Dataset.update(samples=my_models)
 
     def set_all_covers(self, search_txt, model_type):
+        updated_rows = {}
         for model in self.ds_my_models.samples:
             try:
                 if model[0] == self.prelude.no_preview_img and model[1] != 0:
@@ -415,15 +692,16 @@ class MiaoshouRuntime(object):
                     if fname is not None and not os.path.exists(dst):
                         if self.my_model_source == 'miaoshouai.com':
                             cover_url = soup.findAll('img')[0]['src'].replace('/w/150', '/w/450')
-                        r = requests.get(cover_url, timeout=30, stream=True)
+                        r = MiaoshouHttpClient().get(cover_url, stream=True)
                         r.raw.decode_content = True
                         with open(dst, 'wb') as f:
                             shutil.copyfileobj(r.raw, f)
+                        updated_rows[fname] = self.update_local_model_row(os.path.join(mfolder, fname), model_type)
             except Exception as e:
                 print(model[1], cover_url, dst, str(e))
                 continue
 
-        my_models = self.get_local_models(search_txt, model_type)
+        my_models = self.replace_local_model_rows(updated_rows)
         self.ds_my_models.samples = my_models
 
         return gr.Dataset.update(samples=my_models)
@@ -436,7 +714,8 @@ class MiaoshouRuntime(object):
         dst = os.path.join(mfolder, f'{mname}.jpg')
         cover.save(dst)
 
-        my_models = self.get_local_models(search_txt, model_type)
+        row = self.update_local_model_row(os.path.join(mfolder, fname), model_type)
+        my_models = self.replace_local_model_rows({fname: row})
         self.ds_my_models.samples = my_models
 
         return gr.Dataset.update(samples=my_models)
@@ -489,30 +768,15 @@ class MiaoshouRuntime(object):
         if self.my_model_set is None:
             return None
 
-        for model in self.my_model_set:
-            match = False
-
-            for ver in model['modelVersions']:
-                for file in ver['files']:
-                    if fname == file['name']:
-                        match = True
-                    elif lookup_sha256 is not None and 'SHA256' in file['hashes'].keys():
-                        match = (lookup_sha256.upper() == file['hashes']['SHA256'].upper())
-                    elif lookup_shash is not None:
-                        match = (lookup_shash[:10].upper() in [h.upper() for h in file['hashes'].values()])
-
-                    if match:
-                        mid = model['id']
-
-                        res = [
-                            dst,
-                            mid,
-                            [f"{model['name']}/{ver['name']}"],
-                            [mpath.replace(self.prelude.model_type[model_type]+'\\', '')]
-                        ]
-
-            if match:
-                break
+        found = self.my_model_index.find_file(fname, lookup_sha256, lookup_shash)
+        if found is not None:
+            model, ver = found
+            res = [
+                dst,
+                model['id'],
+                [f"{model['name']}/{ver['name']}"],
+                [mpath.replace(self.prelude.model_type[model_type]+'\\', '')]
+            ]
 
         return res
 
@@ -523,33 +787,33 @@ class MiaoshouRuntime(object):
 
         return checkgroup
 
-    def set_nsfw(self, search='', nsfw_checker=False, base_model=None, model_type='All', model_tag='All') -> t.Dict:
+    def set_nsfw(self, search='', nsfw_checker=False, base_model=None, model_type='All', model_tag='All') -> t.Tuple[t.Dict, t.Dict, t.Dict]:
         if base_model is None:
             base_model = []
         self._allow_nsfw = nsfw_checker
         new_list = self.get_images_html(search, nsfw_checker, base_model, model_type, model_tag)
         if self._ds_models is None:
             self.logger.error(f"_ds_models is not initialized")
-            return {}
+            return {}, {}, {}
 
         self._ds_models.samples = new_list
-        return self._ds_models.update(samples=new_list)
+        return (self._ds_models.update(samples=new_list), *self.get_facet_updates())
 
     def set_basemodel(self, sel_base='All'):
         if sel_base == 'All':
-            return gr.CheckboxGroup.update(value=self.prelude.base_model_group)
+            return gr.CheckboxGroup.update(value=self.base_model_choices())
         else:
             return gr.CheckboxGroup.update(value=[])
 
-    def search_model(self, search='', chk_nsfw=False, base_model=None, model_type='All', model_tag='All') -> t.Dict:
+    def search_model(self, search='', chk_nsfw=False, base_model=None, model_type='All', model_tag='All') -> t.Tuple[t.Dict, t.Dict, t.Dict]:
         if self._ds_models is None:
             self.logger.error(f"_ds_models is not initialized")
-            return {}
+            return {}, {}, {}
 
         new_list = self.get_images_html(search, chk_nsfw, base_model, model_type, model_tag)
 
         self._ds_models.samples = new_list
-        return self._ds_models.update(samples=new_list)
+        return (self._ds_models.update(samples=new_list), *self.get_facet_updates())
 
     def search_my_model(self, search_txt='', model_type='Checkpoint') -> t.Dict:
         if self._ds_models is None:
@@ -562,8 +826,7 @@ class MiaoshouRuntime(object):
         return self._ds_my_models.update(samples=new_list)
 
     def get_model_byid(self, mid, model_source) -> t.List:
-        response = requests.get(self.prelude.api_url(model_source) + f'/{mid}')
-        payload = response.json()
+        payload = self.model_api_cache.get_json(self.prelude.api_url(model_source) + f'/{mid}')
         if payload.get("success") is not None and not payload.get("success"):
             return []
 
@@ -603,6 +866,10 @@ class MiaoshouRuntime(object):
                     if not item_name:
                         item_name = "unknown"
 
+                    sha256 = None
+                    if isinstance(file.get('hashes'), dict) and file['hashes'].get('SHA256'):
+                        sha256 = file['hashes']['SHA256']
+
                     self.model_files.append({
                         "id:": file['id'],
                         "url": file['downloadUrl'],
@@ -610,6 +877,7 @@ class MiaoshouRuntime(object):
                         "type": mtype,
                         "size": file['sizeKB'] * 1024 if file.get('sizeKB') else "unknown",
                         "format": file['format'] if file.get('format') else "unknown",
+                        "sha256": sha256,
                         "cover": cover_imgs[0][0] if len(cover_imgs) > 0 else toolkit.get_not_found_image_url(),
                     })
                     file_size = toolkit.get_readable_size(file['sizeKB'] * 1024) if file.get('sizeKB') else ""
@@ -630,23 +898,25 @@ class MiaoshouRuntime(object):
         drop_list = []
         download_url_by_default = None
 
+        mv = None
         if self.model_source == "civitai.com" or self.model_source == "miaoshouai.com":
             m_list = self.get_model_byid(mid, self.model_source)
+            if m_list is not None and len(m_list) > 0:
+                m = m_list[0]
+                if m and m.get('modelVersions'):
+                    mv = next((v for v in m['modelVersions'] if v['name'] == version_name), None)
+            else:
+                return {}, [[]], {}
         else:
-            m_list = [e for e in self.model_set if e['id'] == mid]
-
-        if m_list is not None and len(m_list) > 0:
-            m = m_list[0]
-        else:
-            return {}, [[]], {}
+            m = self.model_index.get_model(mid)
+            if m is None:
+                return {}, [[]], {}
+            mv = self.model_index.get_version(mid, version_name)
 
-        if m and m.get('modelVersions') and len(m.get('modelVersions')) > 0:
-            for mv in m['modelVersions']:
-                if mv['name'] == version_name:
-                    cover_imgs = self.get_coverimg_by_mv(mv)
-                    self._ds_cover_gallery.samples = cover_imgs
-                    drop_list, download_url_by_default = self.get_files_by_mv(mv, m['type'] if m.get('type') else "unknown", cover_imgs)
-                    break
+        if mv is not None:
+            cover_imgs = self.get_coverimg_by_mv(mv)
+            self._ds_cover_gallery.samples = cover_imgs
+            drop_list, download_url_by_default = self.get_files_by_mv(mv, m['type'] if m.get('type') else "unknown", cover_imgs)
 
         return (
             gr.Dropdown.update(choices=drop_list, value=drop_list[0] if len(drop_list) > 0 else []),
@@ -666,18 +936,19 @@ class MiaoshouRuntime(object):
 
         mid = models[1]
 
-        # TODO: use map to enhance the performances
         if self.active_model_set == 'model_set':
             if self.model_source == "civitai.com" or self.model_source == "miaoshouai.com":
                 m_list = self.get_model_byid(mid, self.model_source)
             else:
-                m_list = [e for e in self.model_set if e['id'] == mid]
+                m = self.model_index.get_model(mid)
+                m_list = [m] if m is not None else []
         else:
             if self.my_model_source == "civitai.com" or self.my_model_source == "miaoshouai.com":
                 m_list = self.get_model_byid(mid, self.my_model_source)
                 self._allow_nsfw = True
             else:
-                m_list = [e for e in self.my_model_set if e['id'] == mid]
+                m = self.my_model_index.get_model(mid)
+                m_list = [m] if m is not None else []
 
         if m_list is not None and len(m_list) > 0:
             m = m_list[0]
@@ -816,7 +1087,7 @@ class MiaoshouRuntime(object):
                     if self.my_model_source == 'civitai.com':
                         fname = os.path.join(self.prelude.cache_folder, f"{cover_url.split('/')[-1]}.jpg")
                         if fname is not None and not os.path.exists(fname):
-                            r = requests.get(cover_url, timeout=30, stream=True)
+                            r = MiaoshouHttpClient().get(cover_url, stream=True)
                             r.raw.decode_content = True
                             with open(fname, 'wb') as f:
                                 shutil.copyfileobj(r.raw, f)
@@ -847,7 +1118,47 @@ class MiaoshouRuntime(object):
 
     def get_downloading_status(self):
         (_, _, desc) = self.downloader_manager.tasks_summary()
-        return gr.HTML.update(value=desc)
+        return gr.HTML.update(value=desc), self.get_downloading_tasks()
+
+    def stream_downloading_status(self):
+        # the generator is driven by gradio's queue, it ends once no task is queued or running
+        view = DownloadProgressView()
+        last_html = None
+        for snapshot in self.downloader_manager.snapshots():
+            html = view.render(snapshot)
+            if html != last_html:
+                last_html = html
+                yield gr.HTML.update(value=html)
+
+    def get_downloading_tasks(self, selected: str = None) -> t.Dict:
+        tasks = self.downloader_manager.active_tasks()
+        return gr.Dropdown.update(choices=tasks, value=selected if selected in tasks else None)
+
+    def control_download(self, action: str, local_file: str):
+        target_url = self.downloader_manager.find_target_url(local_file) if local_file else None
+        if target_url is not None:
+            future = {
+                'pause': self.downloader_manager.pause,
+                'resume': self.downloader_manager.resume,
+                'cancel': self.downloader_manager.cancel,
+            }[action](target_url)
+            try:
+                # the looper applies it asynchronously
+                future.result(timeout=MiaoshouRuntime.CONTROL_TIMEOUT)
+            except concurrent.futures.TimeoutError:
+                self.logger.warn(f"{action} of {local_file} is not applied after {MiaoshouRuntime.CONTROL_TIMEOUT} seconds")
+
+        (_, _, desc) = self.downloader_manager.tasks_summary()
+        return gr.HTML.update(value=desc), self.get_downloading_tasks(local_file)
+
+    def pause_download(self, local_file: str):
+        return self.control_download('pause', local_file)
+
+    def resume_download(self, local_file: str):
+        return self.control_download('resume', local_file)
+
+    def cancel_download(self, local_file: str):
+        return self.control_download('cancel', local_file)
 
     def download_model(self, filename: str, des_folder: str):
         model_path = modules.paths.models_path
@@ -894,11 +1205,11 @@ class MiaoshouRuntime(object):
                     cover_fname = os.path.join(model_path, 'Stable-diffusion', cover_fname)
                     model_fname = os.path.join(model_path, 'Stable-diffusion', model_fname)'''
 
-                urls.append((cover_link, f['url'], f['size'], cover_fname, model_fname))
+                urls.append((cover_link, f['url'], f['size'], cover_fname, model_fname, f.get('sha256')))
                 break
 
         c_token = self.prelude.boot_settings['civitai_api']
-        for (cover_url, model_url, total_size, local_cover_name, local_model_name) in urls:
+        for (cover_url, model_url, total_size, local_cover_name, local_model_name, sha256) in urls:
             self.downloader_manager.download(
                 source_url=cover_url,
                 target_file=local_cover_name,
@@ -908,10 +1219,12 @@ class MiaoshouRuntime(object):
             if len(c_token) > 0:
                 model_url += f"?token={c_token}"
 
+            # an identical file already in the library is linked instead of downloaded
             self.downloader_manager.download(
                 source_url=model_url,
                 target_file=local_model_name,
                 estimated_total_size=total_size,
+                expected_checksum=sha256,
             )
 
         #
@@ -1263,6 +1576,7 @@ class MiaoshouRuntime(object):
             if self._model_set is None or self._model_set_last_access_time is None \
                     or self._model_set_last_access_time < model_json_mtime:
                 self._model_set = self.get_all_models(self.model_source)
+                self._model_index = ModelCatalogIndex(self._model_set)
                 self._model_set_last_access_time = model_json_mtime
                 self.logger.info(f"load '{self.model_source}' model data from local file")
         except Exception as e:
@@ -1281,6 +1595,7 @@ class MiaoshouRuntime(object):
             if self._my_model_set is None or self._my_model_set_last_access_time is None \
                 or self._my_model_set_last_access_time < model_json_mtime:
                 self._my_model_set = self.get_all_models(self.my_model_source)
+                self._my_model_index = ModelCatalogIndex(self._my_model_set)
                 self._my_model_set_last_access_time = model_json_mtime
                 self.logger.info(f"load '{self.my_model_source}' model data from local file")
         except Exception as e:
@@ -1290,12 +1605,28 @@ class MiaoshouRuntime(object):
         return self._my_model_set
 
     @property
-    def sorted_model_set(self) -> t.List[t.Dict]:
-        return self._sorted_model_set
+    def model_index(self) -> ModelCatalogIndex:
+        model_set = self.model_set
+        if self._model_index is None or self._model_index.models is not model_set:
+            self._model_index = ModelCatalogIndex(model_set)
+
+        return self._model_index
+
+    @property
+    def my_model_index(self) -> ModelCatalogIndex:
+        my_model_set = self.my_model_set
+        if self._my_model_index is None or self._my_model_index.models is not my_model_set:
+            self._my_model_index = ModelCatalogIndex(my_model_set)
+
+        return self._my_model_index
+
+    @property
+    def sort_by(self) -> str:
+        return self._sort_by
 
-    @sorted_model_set.setter
-    def sorted_model_set(self, newone):
-        self._sorted_model_set = newone
+    @sort_by.setter
+    def sort_by(self, newone: str):
+        self._sort_by = newone
 
     @property
     def allow_nsfw(self) -> bool:
@@ -0,0 +1,91 @@
+import os
+import typing as t
+from threading import Lock
+
+from scripts.msai_logging.msai_logger import Logger
+from scripts.msai_utils import msai_toolkit as toolkit
+
+
+class LocalModelScanCache(object):
+    """
+    persistent cache of resolved 'My Models' rows, an entry is only valid as long as the model
+    file keeps its (size, mtime), its cover keeps its signature and the catalog is not reloaded
+    """
+    VERSION = 1
+
+    def __init__(self, cache_file: str) -> None:
+        self.logger = Logger()
+        self._cache_file = cache_file
+        self._mutex = Lock()
+        self._dirty = False
+        self._dataset: t.Optional[t.Dict[str, t.Any]] = None
+
+    def _load_if_needed(self) -> None:
+        if self._dataset is not None:
+            return
+
+        dataset = None
+        if os.path.isfile(self._cache_file):
+            dataset = toolkit.read_json(self._cache_file)
+        if not isinstance(dataset, dict) or dataset.get("version") != LocalModelScanCache.VERSION:
+            dataset = {"version": LocalModelScanCache.VERSION, "sources": {}}
+        self._dataset = dataset
+
+    def _entries(self, source: str, catalog_mtime: float) -> t.Dict[str, t.Any]:
+        sources = self._dataset["sources"]
+        if source not in sources or sources[source].get("catalog_mtime") != catalog_mtime:
+            # catalog changed, every row of this source has to be resolved again
+            sources[source] = {"catalog_mtime": catalog_mtime, "entries": {}}
+            self._dirty = True
+        return sources[source]["entries"]
+
+    def lookup(self, source: str, catalog_mtime: float, path: str, size: int, mtime: int,
+               cover_signature: t.List[t.Any]) -> t.Optional[t.List[t.Any]]:
+        with self._mutex:
+            self._load_if_needed()
+            entry = self._entries(source, catalog_mtime).get(path)
+            if entry is None or entry["size"] != size or entry["mtime"] != mtime \
+                    or entry["cover"] != cover_signature:
+                return None
+            return entry["row"]
+
+    def store(self, source: str, catalog_mtime: float, path: str, size: int, mtime: int,
+              cover_signature: t.List[t.Any], row: t.List[t.Any]) -> None:
+        with self._mutex:
+            self._load_if_needed()
+            self._entries(source, catalog_mtime)[path] = {
+                "size": size,
+                "mtime": mtime,
+                "cover": cover_signature,
+                "row": row,
+            }
+            self._dirty = True
+
+    def invalidate(self, path: str) -> None:
+        with self._mutex:
+            self._load_if_needed()
+            for source in self._dataset["sources"].values():
+                if source["entries"].pop(path, None) is not None:
+                    self._dirty = True
+
+    def prune(self, source: str, folder: str, seen_paths: t.Iterable[str]) -> None:
+        """
+        drop entries under the folder which are not found by a full scan any more
+        """
+        seen = set(seen_paths)
+        prefix = os.path.join(folder, "")
+        with self._mutex:
+            self._load_if_needed()
+            entries = self._dataset["sources"].get(source, {}).get("entries", {})
+            for path in [p for p in entries.keys() if p.startswith(prefix) and p not in seen]:
+                del entries[path]
+                self._dirty = True
+
+    def flush(self) -> None:
+        with self._mutex:
+            if not self._dirty or self._dataset is None:
+                return
+            if toolkit.write_json_atomic(self._cache_file, self._dataset, indent=None):
+                self._dirty = False
+            else:
+                self.logger.error(f"failed to save local model scan cache into {self._cache_file}")